@@ -40,6 +40,7 @@ try:
     log(f"Final sys.path: {sys.path}")
 
     from fastapi import FastAPI, HTTPException, UploadFile, File, Body
+    from fastapi.concurrency import run_in_threadpool
     from pydantic import BaseModel
     from typing import List, Dict, Any, Optional
 
@@ -67,7 +68,11 @@ try:
     # Import core logic
     try:
         log("Importing src.main...")
-        from src.main import generate_hybrid
+        from src.main import (
+            generate_hybrid, generate_cloud_async, result_cache_stats,
+            get_cactus_pool, warm_cloud, route_predictor_stats, Trace,
+            diag_records, set_diag_level, CLOUD_TIMEOUT_ERRORS, cache_result,
+        )
         log("src.main imported")
         
         log("Importing cactus...")
@@ -85,6 +90,26 @@ except Exception as e:
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+async def warm_model_pool():
+    # Preload the FunctionGemma contexts so the first /chat doesn't pay for it
+    try:
+        pool = await run_in_threadpool(get_cactus_pool)
+        log(f"FunctionGemma pool ready ({pool.size} contexts)")
+    except Exception as e:
+        log(f"FunctionGemma pool failed to load: {e}")
+
+
+@app.on_event("startup")
+async def warm_cloud_client():
+    # Open the Gemini connection and precompute tool declarations up front
+    try:
+        await run_in_threadpool(warm_cloud, merge_tools())
+        log("Gemini client warmed up")
+    except Exception as e:
+        log(f"Gemini warm-up failed: {e}")
+
 # Global model handles (lazy loaded)
 whisper_model = None
 vlm_model = None
@@ -114,6 +139,12 @@ class ChatRequest(BaseModel):
     messages: List[Dict[str, Any]]
     tools: Optional[List[Dict[str, Any]]] = []
     confidence_threshold: float = 0.7
+    rule_first: bool = False
+    hedge: bool = False
+    deadline_ms: Optional[float] = None
+    predict_route: bool = False
+    semantic_cache: bool = False
+    trace: bool = False
 
 # ---------------------------------------------------------------------------
 # Standard System Tools
@@ -201,52 +232,102 @@ SYSTEM_TOOLS = [
     }
 ]
 
+def merge_tools(request_tools=None):
+    """Request tools plus system, Notion and Slack tools (deduplicated by name)."""
+    # Inject available tools if none provided or merge them
+    current_tools = list(request_tools or [])
+    
+    # 1. Add Standard System Tools (ALWAYS)
+    existing_names = {t["name"] for t in current_tools}
+    for tool in SYSTEM_TOOLS:
+        if tool["name"] not in existing_names:
+            current_tools.append(tool)
+            existing_names.add(tool["name"])
+    
+    # Add Notion tools if available
+    if notion_tools:
+        try:
+            notion_schemas = notion_tools.tool_schemas()
+            # Avoid duplicates by name
+            existing_names = {t["name"] for t in current_tools}
+            for tool_wrapper in notion_schemas:
+                # tool_schemas returns {type: function, function: {...}}
+                # We need the inner function dict
+                tool = tool_wrapper.get("function", tool_wrapper)
+                if tool["name"] not in existing_names:
+                    current_tools.append(tool)
+        except Exception as e:
+            print(f"Error loading Notion tools: {e}")
+
+    # Add Slack tools if available
+    if slack_tools:
+        try:
+            slack_schemas = slack_tools.tool_schemas()
+            existing_names = {t["name"] for t in current_tools}
+            for tool_wrapper in slack_schemas:
+                tool = tool_wrapper.get("function", tool_wrapper)
+                if tool["name"] not in existing_names:
+                    current_tools.append(tool)
+        except Exception as e:
+            print(f"Error loading Slack tools: {e}")
+
+    return current_tools
+
+
 @app.post("/chat")
 async def chat(request: ChatRequest):
     try:
-        # Inject available tools if none provided or merge them
-        current_tools = request.tools or []
-        
-        # 1. Add Standard System Tools (ALWAYS)
-        existing_names = {t["name"] for t in current_tools}
-        for tool in SYSTEM_TOOLS:
-            if tool["name"] not in existing_names:
-                current_tools.append(tool)
-                existing_names.add(tool["name"])
-        
-        # Add Notion tools if available
-        if notion_tools:
-            try:
-                notion_schemas = notion_tools.tool_schemas()
-                # Avoid duplicates by name
-                existing_names = {t["name"] for t in current_tools}
-                for tool_wrapper in notion_schemas:
-                    # tool_schemas returns {type: function, function: {...}}
-                    # We need the inner function dict
-                    tool = tool_wrapper.get("function", tool_wrapper)
-                    if tool["name"] not in existing_names:
-                        current_tools.append(tool)
-            except Exception as e:
-                print(f"Error loading Notion tools: {e}")
-
-        # Add Slack tools if available
-        if slack_tools:
-            try:
-                slack_schemas = slack_tools.tool_schemas()
-                existing_names = {t["name"] for t in current_tools}
-                for tool_wrapper in slack_schemas:
-                    tool = tool_wrapper.get("function", tool_wrapper)
-                    if tool["name"] not in existing_names:
-                        current_tools.append(tool)
-            except Exception as e:
-                print(f"Error loading Slack tools: {e}")
-
-        # Call the hackathon logic
-        result = generate_hybrid(
-            request.messages, 
-            current_tools, 
-            confidence_threshold=request.confidence_threshold
+        current_tools = merge_tools(request.tools)
+        trace = Trace() if request.trace else None
+
+        # Call the hackathon logic (in a worker thread so concurrent requests
+        # run on separate pooled contexts instead of blocking the event loop)
+        result = await run_in_threadpool(
+            generate_hybrid,
+            request.messages,
+            current_tools,
+            confidence_threshold=request.confidence_threshold,
+            rule_first=request.rule_first,
+            hedge=request.hedge,
+            cloud_fallback=False,
+            deadline_ms=request.deadline_ms,
+            predict_route=request.predict_route,
+            semantic_cache=request.semantic_cache,
+            trace=trace,
         )
+
+        # Cloud fallback streams on the event loop and returns as soon as
+        # the expected function calls have arrived
+        if result.get("cloud_handoff"):
+            budget = result.get("budget")
+            cloud_start = time.perf_counter()
+            try:
+                cloud = await generate_cloud_async(
+                    request.messages, current_tools,
+                    timeout_ms=budget["remaining_ms"] if budget else None,
+                )
+                cloud["source"] = "cloud (fallback)"
+                outcome = "ok" if cloud["function_calls"] else "no call"
+            except CLOUD_TIMEOUT_ERRORS as e:
+                # Same degraded result generate_hybrid gives when the cloud runs out of time
+                if budget is None:
+                    raise
+                budget["cut"].append("cloud")
+                cloud = {"function_calls": [], "total_time_ms": 0.0, "source": "none (deadline)",
+                         "budget": budget, "stream_early_exit": False}
+                outcome = f"error: {type(e).__name__}"
+            if trace:
+                trace.add("cloud", cloud_start, time.perf_counter(),
+                          outcome=outcome, stream_early_exit=cloud["stream_early_exit"])
+            if cloud["source"] == "cloud (fallback)":
+                # generate_hybrid never saw this answer; cache it so repeats stay local
+                await run_in_threadpool(
+                    cache_result, request.messages, current_tools, cloud,
+                    semantic_cache=request.semantic_cache,
+                )
+            cloud["local_confidence"] = result.get("confidence", 0)
+            cloud["total_time_ms"] += result["total_time_ms"]
+            result = cloud
         
         # Add available tools to the result for frontend visibility
         result["available_tools"] = [t["name"] for t in current_tools]
@@ -261,10 +342,14 @@ async def chat(request: ChatRequest):
                 
                 tool_result = {"ok": False, "error": "Unknown tool or client not available"}
                 
+                tool_start = time.perf_counter()
                 if name.startswith("notion_") and notion_tools:
                     tool_result = notion_tools.call_tool(name, args)
                 elif name.startswith("slack_") and slack_tools:
                     tool_result = slack_tools.call_tool(name, args)
+                if trace:
+                    trace.add("tool_execution", tool_start, time.perf_counter(), tool=name,
+                              outcome="ok" if tool_result.get("ok") else "error")
                 
                 # Tag with name for context
                 tool_result["tool"] = name
@@ -281,6 +366,8 @@ async def chat(request: ChatRequest):
                 else:
                     result["response"] += summary
         
+        if trace:
+            result["trace"] = trace.export()
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -348,6 +435,38 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters for the router's query-result cache."""
+    return result_cache_stats()
+
+
+@app.get("/pool/stats")
+async def pool_stats():
+    """Checkouts, waits and utilization of the FunctionGemma context pool."""
+    try:
+        return get_cactus_pool().stats()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/router/stats")
+async def router_stats():
+    """Training progress and weights of the learned local/cloud route predictor."""
+    return route_predictor_stats()
+
+
+@app.get("/debug/diag")
+async def debug_diag(limit: int = 200, level: str = "debug", set_level: Optional[str] = None):
+    """Recent router diagnostics from the in-memory ring buffer (optionally change the level)."""
+    try:
+        if set_level:
+            set_diag_level(set_level)
+        return {"records": diag_records(limit=limit, level=level)}
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Unknown diagnostics level: {e}")
+
+
 # ---------------- Notion endpoints ---------------------------------
 
 
@@ -3,12 +3,40 @@ import sys
 sys.path.insert(0, "cactus/python/src")
 functiongemma_path = "cactus/weights/functiongemma-270m-it"
 
-import json, os, time, re, atexit
+import json, os, time, re, math, random, bisect, atexit, hashlib, copy, threading, queue, asyncio, inspect
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError as _FutureCancelled, TimeoutError as _FutureTimeout
+from contextlib import contextmanager
 from typing import Optional
 from cactus import cactus_init, cactus_complete, cactus_destroy, cactus_reset
 from google import genai
 from google.genai import types
 
+# Optional: the semantic cache needs query embeddings and vectorized search.
+try:
+    from cactus import cactus_embed
+except ImportError:
+    cactus_embed = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+# Optional: KV-state snapshots for prefix reuse (engine builds that expose them).
+try:
+    from cactus import cactus_prefill, cactus_snapshot, cactus_restore
+except ImportError:
+    cactus_prefill = cactus_snapshot = cactus_restore = None
+# Optional: token callbacks + cactus_stop for early-stopped streaming decode.
+try:
+    from cactus import cactus_stop
+except ImportError:
+    cactus_stop = None
+# httpx (a google-genai dependency) raises its own timeout types.
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 
 # ---------------------------------------------------------------------------
 # Environment & Config
@@ -42,32 +70,352 @@ def _get_gemini_api_key() -> Optional[str]:
     return key.strip() if key else None
 
 
-_DIAG = True
+# ---------------------------------------------------------------------------
+# Diagnostics — level-gated, lazily formatted, ring-buffered
+# ---------------------------------------------------------------------------
+
+_DEBUG, _INFO, _WARNING, _OFF = 10, 20, 30, 100
+_DIAG_LEVELS = {"debug": _DEBUG, "info": _INFO, "warning": _WARNING, "off": _OFF}
+_DIAG_BUFFER = 2000
+
+
+class _Json:
+    """Argument wrapper that defers json.dumps until the record is formatted."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, ensure_ascii=False, default=_json_default)
+
+
+def _json_default(obj):
+    if isinstance(obj, FunctionCall):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def _format_record(msg, args):
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except (TypeError, ValueError):
+        return " ".join([msg, *map(str, args)])
+
+
+class _DiagLog:
+    """
+    Bounded in-memory ring of (seq, time, level, msg, args) records. Records
+    are only formatted when written or queried; with echo, a daemon thread
+    drains new ones to `stream` (default: the current sys.stdout) so the
+    request path never blocks on stdout. When the writer falls behind by more
+    than the ring's capacity, the oldest records are dropped (counted in
+    `dropped`).
+    """
+
+    def __init__(self, level=_DEBUG, capacity=_DIAG_BUFFER, echo=True, stream=None):
+        self.level = level
+        self.echo = echo
+        self.stream = stream
+        self.dropped = 0
+        self._ring = deque(maxlen=capacity)
+        self._seq = 0
+        self._written = 0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._writer = None
+
+    def log(self, level, msg, args):
+        with self._cond:
+            self._seq += 1
+            self._ring.append((self._seq, time.time(), level, msg, args))
+            if self.echo:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name="diag-writer", daemon=True)
+                    self._writer.start()
+                self._cond.notify()
+
+    def _pending(self):
+        """Records not yet written, oldest first (caller holds _cond)."""
+        pending = []
+        for record in reversed(self._ring):
+            if record[0] <= self._written:
+                break
+            pending.append(record)
+        pending.reverse()
+        if pending and pending[0][0] > self._written + 1:
+            self.dropped += pending[0][0] - self._written - 1
+        self._written = self._seq
+        return pending
+
+    def _write(self, pending):
+        if not pending:
+            return
+        stream = self.stream or sys.stdout
+        with self._write_lock:
+            stream.write("".join(f"    [diag] {_format_record(r[3], r[4])}\n" for r in pending))
+            stream.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._written == self._seq:
+                    self._cond.wait()
+                pending = self._pending()
+            try:
+                self._write(pending)
+            except (OSError, ValueError):
+                pass
+
+    def flush(self):
+        """Write anything still pending (e.g. at exit) on the calling thread."""
+        if not self.echo:
+            return
+        with self._cond:
+            pending = self._pending()
+        try:
+            self._write(pending)
+        except (OSError, ValueError):
+            pass
+
+    def records(self, limit=200, min_level=_DEBUG):
+        """The newest `limit` records at or above `min_level`, formatted, oldest first."""
+        with self._cond:
+            snapshot = list(self._ring)
+        out = []
+        for seq, ts, level, msg, args in reversed(snapshot):
+            if level < min_level:
+                continue
+            out.append({"seq": seq, "time": ts, "level": _level_name(level), "message": _format_record(msg, args)})
+            if len(out) >= limit:
+                break
+        out.reverse()
+        return out
+
+
+def _level_name(level):
+    return next((name for name, value in _DIAG_LEVELS.items() if value == level), str(level))
+
+
+_diag_log = _DiagLog(
+    level=_DIAG_LEVELS.get(os.environ.get("DIAG_LEVEL", "debug").lower(), _DEBUG),
+    echo=os.environ.get("DIAG_ECHO", "1") != "0",
+)
+atexit.register(_diag_log.flush)
+
+
+def _diag(msg, *args, level=_DEBUG):
+    """Log a %-style message; nothing is formatted or stored below the current level."""
+    if level >= _diag_log.level:
+        _diag_log.log(level, msg, args)
 
-def _diag(*args):
-    if _DIAG:
-        print("    [diag]", *args, flush=True)
+
+def set_diag_level(name):
+    """Change the diagnostics level at runtime ("debug", "info", "warning" or "off")."""
+    _diag_log.level = _DIAG_LEVELS[name.lower()]
+
+
+def diag_records(limit=200, level="debug"):
+    """Recent diagnostics from the in-memory ring buffer, oldest first."""
+    return _diag_log.records(limit=limit, min_level=_DIAG_LEVELS[level.lower()])
+
+
+# ---------------------------------------------------------------------------
+# Model pool – N preloaded FunctionGemma contexts, checked out per request
+# ---------------------------------------------------------------------------
+
+_POOL_SIZE = 3
+_POOL_TIMEOUT_S = 30.0
+
+
+class CactusModelPool:
+    """
+    Thread-safe pool of FunctionGemma contexts.
+
+    Each caller checks out a context for exclusive use and checks it back
+    in when done; checkin resets the context so no KV state leaks between
+    requests. Contexts are created up front and destroyed on close().
+    """
+
+    def __init__(self, model_path=functiongemma_path, size=_POOL_SIZE):
+        self.model_path = model_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._models = []
+        for _ in range(size):
+            model = cactus_init(model_path)
+            self._models.append(model)
+            self._idle.put(model)
+        self._lock = threading.Lock()
+        self._checked_out = {}  # id(model) -> checkout time
+        self._created = time.monotonic()
+        self._busy_s = 0.0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait_ms = 0.0
+
+    def checkout(self, timeout=_POOL_TIMEOUT_S):
+        """Take an idle context, waiting up to `timeout` seconds for one."""
+        start = time.monotonic()
+        try:
+            model = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.waits += 1
+            try:
+                model = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    self.timeouts += 1
+                raise TimeoutError(
+                    f"No FunctionGemma context free after {timeout}s (pool size {self.size})"
+                )
+        now = time.monotonic()
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait_ms += (now - start) * 1000
+            self._checked_out[id(model)] = now
+        return model
+
+    def checkin(self, model):
+        """Reset a context and return it to the pool."""
+        try:
+            cactus_reset(model)
+        finally:
+            with self._lock:
+                since = self._checked_out.pop(id(model), None)
+                if since is not None:
+                    self._busy_s += time.monotonic() - since
+            self._idle.put(model)
+
+    @contextmanager
+    def context(self, timeout=_POOL_TIMEOUT_S):
+        model = self.checkout(timeout)
+        try:
+            yield model
+        finally:
+            self.checkin(model)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            busy_s = self._busy_s + sum(now - t for t in self._checked_out.values())
+            capacity_s = self.size * (now - self._created)
+            return {
+                "size": self.size,
+                "in_use": len(self._checked_out),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else 0.0,
+                "utilization": busy_s / capacity_s if capacity_s > 0 else 0.0,
+                "prefix_cache": _prefix_cache.stats(),
+            }
+
+    def close(self):
+        while self._models:
+            model = self._models.pop()
+            _prefix_cache.drop(model)
+            cactus_destroy(model)
+
+
+_cactus_pool = None
+_cactus_pool_lock = threading.Lock()
+
+
+def get_cactus_pool(size=None):
+    """Return the process-wide model pool, creating it (size contexts) on first use."""
+    global _cactus_pool
+    if _cactus_pool is None:
+        with _cactus_pool_lock:
+            if _cactus_pool is None:
+                _cactus_pool = CactusModelPool(size=size or _POOL_SIZE)
+                atexit.register(_cactus_pool.close)
+    return _cactus_pool
 
 
 # ---------------------------------------------------------------------------
-# Model caching – load once, reuse across all calls, destroy on exit
+# Prefix cache — reuse the prefilled system prompt + tool list KV state
 # ---------------------------------------------------------------------------
 
-_cactus_model = None
+_PREFIX_CACHE = True
+_PREFIX_CACHE_PER_CONTEXT = 4
+
+
+class _PrefixCache:
+    """
+    Per-context LRU of KV snapshots taken right after prefilling a
+    (system prompt, tool list) prefix. Snapshots belong to the context that
+    produced them, so pooled contexts never share state.
+    """
+
+    def __init__(self, per_context=_PREFIX_CACHE_PER_CONTEXT):
+        self.per_context = per_context
+        self.hits = 0
+        self.misses = 0
+        self._by_context = {}  # id(model) -> OrderedDict(key -> snapshot)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return _PREFIX_CACHE and None not in (cactus_prefill, cactus_snapshot, cactus_restore)
+
+    def get(self, model, key):
+        with self._lock:
+            snaps = self._by_context.get(id(model))
+            snap = snaps.get(key) if snaps else None
+            if snap is None:
+                self.misses += 1
+                return None
+            snaps.move_to_end(key)
+            self.hits += 1
+            return snap
+
+    def put(self, model, key, snapshot):
+        with self._lock:
+            snaps = self._by_context.setdefault(id(model), OrderedDict())
+            snaps[key] = snapshot
+            while len(snaps) > self.per_context:
+                snaps.popitem(last=False)
+
+    def drop(self, model):
+        with self._lock:
+            self._by_context.pop(id(model), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "snapshots": sum(len(v) for v in self._by_context.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
 
-def _get_cactus_model():
-    global _cactus_model
-    if _cactus_model is None:
-        _cactus_model = cactus_init(functiongemma_path)
-        atexit.register(_cleanup_cactus_model)
-    return _cactus_model
+_prefix_cache = _PrefixCache()
 
 
-def _cleanup_cactus_model():
-    global _cactus_model
-    if _cactus_model is not None:
-        cactus_destroy(_cactus_model)
-        _cactus_model = None
+def _reset_to_prefix(model, prefix_messages, cactus_tools, tools_fp):
+    """
+    Bring `model` to the state right after prefilling (prefix_messages, tools):
+    restore a cached snapshot, or reset + prefill + snapshot on first use.
+    Without engine snapshot support this is a plain cactus_reset.
+    """
+    if not _prefix_cache.enabled:
+        cactus_reset(model)
+        return
+    key = (hashlib.sha1(json.dumps(prefix_messages).encode("utf-8")).hexdigest(), tools_fp)
+    snap = _prefix_cache.get(model, key)
+    if snap is not None:
+        cactus_restore(model, snap)
+        return
+    cactus_reset(model)
+    cactus_prefill(model, prefix_messages, tools=cactus_tools)
+    _prefix_cache.put(model, key, cactus_snapshot(model))
 
 
 # ---------------------------------------------------------------------------
@@ -126,6 +474,79 @@ def _repair_and_parse(raw_str):
     return None
 
 
+# ---------------------------------------------------------------------------
+# FunctionCall — compact, hashable call record used inside the router
+# ---------------------------------------------------------------------------
+
+_SCALARS = (str, int, float, bool, type(None))
+
+
+def _freeze(value):
+    """Hashable, type-tagged form of a JSON-like value (dict key order ignored)."""
+    if isinstance(value, _SCALARS):
+        return (type(value), value)  # keeps 1, 1.0 and True apart, as json.dumps does
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((k, _freeze(v)) for k, v in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(v) for v in value))
+    return (type(value), repr(value))
+
+
+class FunctionCall:
+    """
+    One validated tool call with its structural key and hash computed once,
+    so deduplication and merging never re-serialize arguments.
+
+    Treated as immutable (with_arguments returns a new call). The router
+    passes these around end to end; results leaving the public API carry
+    plain {"name", "arguments"} dicts (see to_dict / _export_result).
+    """
+
+    __slots__ = ("name", "arguments", "key", "_hash")
+
+    def __init__(self, name, arguments=None):
+        self.name = name
+        self.arguments = arguments if arguments is not None else {}
+        self.key = (name, _freeze(self.arguments))
+        self._hash = hash(self.key)
+
+    @classmethod
+    def of(cls, call):
+        """A FunctionCall for a {"name", "arguments"} dict (FunctionCalls pass through)."""
+        if isinstance(call, cls):
+            return call
+        return cls(call.get("name"), call.get("arguments", {}))
+
+    def with_arguments(self, **changes):
+        return FunctionCall(self.name, {**self.arguments, **changes})
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "arguments": {
+                k: copy.deepcopy(v) if isinstance(v, (dict, list)) else v
+                for k, v in self.arguments.items()
+            },
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, FunctionCall):
+            return NotImplemented
+        return self._hash == other._hash and self.key == other.key
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"FunctionCall({self.name!r}, {self.arguments!r})"
+
+
+def _export_result(result):
+    """Convert a result's FunctionCalls to the public dict shape (in place)."""
+    result["function_calls"] = [call.to_dict() for call in result["function_calls"]]
+    return result
+
+
 # ---------------------------------------------------------------------------
 # Post-processing helpers
 # ---------------------------------------------------------------------------
@@ -174,51 +595,147 @@ def _is_valid_arg(val):
 
 
 def _filter_valid_calls(function_calls, tools):
-    """Keep only calls that reference real tools with all required args non-empty."""
+    """
+    Keep only calls that reference real tools with all required args non-empty.
+    Accepts raw call dicts or FunctionCalls; returns FunctionCalls.
+    """
     tool_map = {t["name"]: t for t in tools}
     valid = []
     for call in function_calls:
-        name = call.get("name")
-        if name not in tool_map:
+        call = FunctionCall.of(call)
+        if call.name not in tool_map:
             continue
-        required = tool_map[name]["parameters"].get("required", [])
-        args = call.get("arguments", {})
+        required = tool_map[call.name]["parameters"].get("required", [])
+        args = call.arguments
         if all(r in args and _is_valid_arg(args[r]) for r in required):
             valid.append(call)
     return valid
 
 
 def _deduplicate_calls(function_calls):
-    """Remove exact-duplicate function calls."""
-    seen = set()
-    unique = []
-    for call in function_calls:
-        key = (call["name"], json.dumps(call.get("arguments", {}), sort_keys=True))
-        if key not in seen:
-            seen.add(key)
-            unique.append(call)
-    return unique
+    """Remove exact-duplicate FunctionCalls, keeping the first of each."""
+    return list(dict.fromkeys(function_calls))
+
+
+# ---------------------------------------------------------------------------
+# Query analysis — text features computed once per query
+# ---------------------------------------------------------------------------
+
+_PUNCT = '.,!?;:'
+_PUNCT_WIDE = '.,!?;:\'"()[]{}'
+# Markers the extraction heuristics look up in every query.
+_QUERY_MARKERS = (" at ", " in ", " saying ", " that says ", " about ", " to ", " called ")
+
+
+class QueryAnalysis:
+    """
+    Read-only per-query features shared by every heuristic: lowercase text,
+    whitespace words (with their offsets and punctuation-stripped forms),
+    tokens, numbers and clock times, proper nouns, intent parts and the
+    first position of each of _QUERY_MARKERS.
+    """
+
+    __slots__ = (
+        "text", "lower", "words", "starts", "trimmed", "clean_lower", "tokens",
+        "token_set", "numbers", "proper_nouns", "intents", "markers",
+    )
+
+    def __init__(self, text):
+        matches = list(re.finditer(r"\S+", text))
+        words = tuple(m.group() for m in matches)
+        trimmed = tuple(w.strip(_PUNCT) for w in words)
+        tokens = tuple(_tokenize(text))
+
+        numbers = [int(t) for t in trimmed if t.isdigit()]
+        for t in trimmed:
+            if ":" in t:
+                parts = t.split(":")
+                if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+                    numbers.extend([int(parts[0]), int(parts[1])])
+
+        nouns = []
+        for i, w in enumerate(words):
+            cleaned = w.strip(_PUNCT_WIDE)
+            if not cleaned or i == 0 or not cleaned[0].isupper():
+                continue
+            if cleaned.isdigit() or cleaned.upper() in ("AM", "PM"):
+                continue
+            nouns.append(cleaned)
+
+        lower = text.lower()
+        fields = {
+            "text": text,
+            "lower": lower,
+            "words": words,
+            "starts": tuple(m.start() for m in matches),
+            "trimmed": trimmed,
+            "clean_lower": tuple(w.strip(_PUNCT_WIDE).lower() for w in words),
+            "tokens": tokens,
+            "token_set": frozenset(tokens),
+            "numbers": tuple(numbers),
+            "proper_nouns": tuple(nouns),
+            "intents": tuple(_split_intents(text)),
+            "markers": {m: lower.find(m) for m in _QUERY_MARKERS},
+        }
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("QueryAnalysis is immutable")
+
+    def find(self, marker):
+        """First index of `marker` in the lowercase text (-1 if absent)."""
+        pos = self.markers.get(marker)
+        return self.lower.find(marker) if pos is None else pos
+
+    def words_before(self, pos):
+        """Number of words that start before character offset `pos`."""
+        return bisect.bisect_left(self.starts, pos)
+
+
+_QUERY_CACHE_SIZE = 256
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+
+def analyze_query(text):
+    """QueryAnalysis for `text`, shared through a small LRU cache."""
+    with _query_cache_lock:
+        query = _query_cache.get(text)
+        if query is not None:
+            _query_cache.move_to_end(text)
+            return query
+    query = QueryAnalysis(text)
+    with _query_cache_lock:
+        _query_cache[text] = query
+        while len(_query_cache) > _QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+    return query
+
+
+def _as_query(query):
+    return query if isinstance(query, QueryAnalysis) else analyze_query(query)
 
 
 # ---------------------------------------------------------------------------
 # Argument-query overlap scoring — used to compare model vs schema results
 # ---------------------------------------------------------------------------
 
-def _arg_query_overlap(calls, user_text, tools=None, extra_nouns=None):
+def _arg_query_overlap(calls, query, tools=None, extra_nouns=None):
     """Score how well argument values align with the query text."""
-    text_lower = user_text.lower()
+    text_lower = _as_query(query).lower
     tool_map = {t["name"]: t for t in tools} if tools else {}
     nouns_lower = {n.lower() for n in extra_nouns} if extra_nouns else set()
     score = 0
     
     for call in calls:
-        tool_name = call.get("name")
+        tool_name = call.name
         tool_name_words = set()
         if tool_name:
             for part in tool_name.split("_"):
                 tool_name_words.add(part.lower())
 
-        for val in call.get("arguments", {}).values():
+        for val in call.arguments.values():
             if isinstance(val, int):
                 if val == 0:
                     continue
@@ -276,37 +793,32 @@ def _words_similar(a, b):
     return False
 
 
-def _tool_relevance(tool, query_words):
-    """Score how relevant a tool is to the query using its full schema."""
-    tool_words = set()
-    for part in tool["name"].split("_"):
-        tool_words.add(part.lower())
-    for word in _tokenize(tool.get("description", "")):
-        tool_words.add(word)
-    for pname, pschema in tool["parameters"].get("properties", {}).items():
-        for part in pname.split("_"):
-            tool_words.add(part.lower())
-        for word in _tokenize(pschema.get("description", "")):
-            tool_words.add(word)
-    tool_words -= _STOP_WORDS
-    query_clean = query_words - _STOP_WORDS
+_SYNONYMS = {
+    "text": "message",
+    "mail": "message",
+    "wake": "alarm",
+    "tune": "music",
+    "track": "music",
+    "song": "music",
+}
 
-    # Expand query words with synonyms
+
+def _expand_query(query_words):
+    """Drop stop words and add synonyms (shared by linear and indexed scoring)."""
+    query_clean = query_words - _STOP_WORDS
     expanded_query = set(query_clean)
-    _SYNONYMS = {
-        "text": "message",
-        "mail": "message",
-        "wake": "alarm",
-        "tune": "music",
-        "track": "music",
-        "song": "music",
-    }
     for w in query_clean:
         if w in _SYNONYMS:
             expanded_query.add(_SYNONYMS[w])
+    return expanded_query
+
+
+def _tool_relevance(tool, query_words, entry=None):
+    """Score how relevant a tool is to the query using its full schema."""
+    tool_words = (entry or _ToolEntry(tool)).vocab
 
     matches = 0
-    for qw in expanded_query:
+    for qw in _expand_query(query_words):
         for tw in tool_words:
             if _words_similar(qw, tw):
                 matches += 1
@@ -315,17 +827,13 @@ def _tool_relevance(tool, query_words):
     return matches / max(len(tool_words), 1)
 
 
-def _find_best_tool(user_text, tools):
+def _find_best_tool(query, tools, index=None):
     """Pick the most relevant tool for the query using bag-of-words scoring."""
-    query_words = set(_tokenize(user_text))
-    best_tool = None
-    best_score = 0.0
-    for tool in tools:
-        score = _tool_relevance(tool, query_words)
-        if score > best_score:
-            best_score = score
-            best_tool = tool
-    return best_tool if best_score > 0.05 else None
+    index = index or _get_tool_index(tools)
+    ranked = index.top_k(_as_query(query).token_set, 1)
+    if ranked and ranked[0][1] > 0.05:
+        return ranked[0][0]
+    return None
 
 
 def _identify_tool_from_text(text, tools):
@@ -342,299 +850,724 @@ def _identify_tool_from_text(text, tools):
     return best_tool if best_count > 0 else None
 
 
+# ---------------------------------------------------------------------------
+# ToolIndex — per-tool schema heuristics, built once per distinct tool list
+# ---------------------------------------------------------------------------
+
+_CATEGORY_KEYWORDS = {
+    "time": ["time", "when", "schedule"],
+    "location": ["location", "city", "place"],
+    "name": ["name", "person", "contact", "recipient"],
+    "person": ["person", "contact", "recipient"],
+    "content": ["content", "message", "text", "query"],
+    "title": ["title", "subject", "topic"],
+    "channel": ["channel", "mention", "recipient"],
+}
+
+
+class _PrefixTrie:
+    """
+    Character trie over schema words of length >= 3.
+
+    has_similar(word) is _words_similar(word, sw) for any inserted sw, in
+    O(len(word)): either some sw ends on the walk (sw is a prefix of word)
+    or the walk consumes all of word (word is a prefix of some sw).
+    """
+
+    __slots__ = ("root",)
+    _END = ""  # never a real character key
+
+    def __init__(self, words=()):
+        self.root = {}
+        for w in words:
+            if len(w) >= 3:
+                node = self.root
+                for ch in w:
+                    node = node.setdefault(ch, {})
+                node[self._END] = True
+
+    def has_similar(self, word):
+        if len(word) < 3:
+            return False
+        node = self.root
+        for ch in word:
+            node = node.get(ch)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return True
+
+
+# Rough token cost of one emitted call: markers, braces and name, plus a
+# key and a typical value per parameter.
+_CALL_BASE_TOKENS = 12
+_ARG_VALUE_TOKENS = {"integer": 6, "number": 8, "boolean": 4, "string": 24, "array": 40, "object": 40}
+
+
+def _call_token_estimate(name, props):
+    tokens = _CALL_BASE_TOKENS + len(name) // 4
+    for pname, pschema in props.items():
+        tokens += 3 + len(pname) // 4 + _ARG_VALUE_TOKENS.get(pschema.get("type", "string"), 24)
+    return tokens
+
+
+class _ToolEntry:
+    """Tokenized schema data for one tool (vocabulary, strip set, param categories)."""
+
+    __slots__ = (
+        "tool", "name", "props", "required", "vocab", "schema_words",
+        "strip_set", "strip_trie", "int_params", "str_params", "categories", "call_tokens",
+        "plan",
+    )
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.name = tool["name"]
+        params = tool.get("parameters", {})
+        self.props = params.get("properties", {})
+        self.required = params.get("required", [])
+
+        name_parts = {part.lower() for part in self.name.split("_")}
+        desc_words = set(_tokenize(tool.get("description", "")))
+        pname_parts = set()
+        pdesc_words = set()
+        for pname, pschema in self.props.items():
+            for part in pname.split("_"):
+                pname_parts.add(part.lower())
+            pdesc_words.update(_tokenize(pschema.get("description", "")))
+
+        # Relevance vocabulary includes parameter names; the strip set does not.
+        self.vocab = frozenset((name_parts | desc_words | pname_parts | pdesc_words) - _STOP_WORDS)
+        self.schema_words = frozenset(name_parts | desc_words | pdesc_words)
+        self.strip_set = _STOP_WORDS | self.schema_words
+        self.strip_trie = _PrefixTrie(self.schema_words)
+
+        self.int_params = [(k, v) for k, v in self.props.items() if v.get("type") == "integer"]
+        self.str_params = [(k, v) for k, v in self.props.items() if v.get("type") == "string"]
+        self.categories = {}
+        for pname, pschema in self.str_params:
+            desc = (pschema.get("description", "") + " " + pname).lower()
+            self.categories[pname] = frozenset(
+                cat for cat, kws in _CATEGORY_KEYWORDS.items()
+                if any(kw in desc for kw in kws)
+            )
+        self.call_tokens = _call_token_estimate(self.name, self.props)
+        self.plan = ExtractionPlan(self)
+
+
+# Tool lists at least this large also get a _ToolMatrix (when numpy is available).
+_TOOL_MATRIX_MIN_TOOLS = 128
+
+
+class _ToolMatrix:
+    """
+    Sparse word-by-tool incidence matrix (CSR rows over the vocabulary words).
+
+    Row w lists the tools whose vocab contains w. A query word qw selects the
+    rows of every word similar to it (qw itself, words qw prefixes, words
+    prefixing qw) and a tool matches qw when any selected row holds it, so a
+    query is scored by one gather over the selected rows, a per-(qw, tool)
+    dedup and a bincount, divided by the vocabulary sizes. Synonyms are added
+    on the query side by _expand_query, exactly as _tool_relevance does.
+    """
+
+    __slots__ = ("n_tools", "word_ids", "prefix_rows", "indptr", "indices", "vocab_sizes")
+
+    def __init__(self, entries):
+        self.n_tools = len(entries)
+        self.word_ids = {w: i for i, w in enumerate(sorted({w for e in entries for w in e.vocab}))}
+        rows = [[] for _ in self.word_ids]
+        for tid, entry in enumerate(entries):
+            for w in entry.vocab:
+                rows[self.word_ids[w]].append(tid)
+        lengths = np.fromiter((len(r) for r in rows), dtype=np.int64, count=len(rows))
+        self.indptr = np.concatenate((np.zeros(1, dtype=np.int64), np.cumsum(lengths)))
+        self.indices = np.fromiter((tid for r in rows for tid in r), dtype=np.int64,
+                                   count=int(self.indptr[-1]))
+        prefix_rows = {}
+        for w, i in self.word_ids.items():
+            for k in range(3, len(w)):
+                prefix_rows.setdefault(w[:k], []).append(i)
+        self.prefix_rows = prefix_rows
+        self.vocab_sizes = np.fromiter((max(len(e.vocab), 1) for e in entries), dtype=np.float64,
+                                       count=self.n_tools)
+
+    def _similar_rows(self, qw):
+        """Row ids of every vocabulary word _words_similar to qw (may repeat)."""
+        rows = []
+        i = self.word_ids.get(qw)
+        if i is not None:
+            rows.append(i)
+        if len(qw) >= 3:
+            rows.extend(self.prefix_rows.get(qw, ()))  # qw is a proper prefix of tw
+            for k in range(3, len(qw)):                # tw is a proper prefix of qw
+                i = self.word_ids.get(qw[:k])
+                if i is not None:
+                    rows.append(i)
+        return rows
+
+    def scores(self, query_words):
+        """Dense relevance vector over all tools, equal to _tool_relevance per tool."""
+        rows, labels = [], []
+        for label, qw in enumerate(_expand_query(query_words)):
+            hit = self._similar_rows(qw)
+            rows.extend(hit)
+            labels.extend([label] * len(hit))
+        if not rows:
+            return np.zeros(self.n_tools)
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        ends = np.cumsum(lengths)
+        gather = np.repeat(starts - (ends - lengths), lengths) + np.arange(ends[-1])
+        pairs = np.repeat(np.asarray(labels, dtype=np.int64), lengths) * self.n_tools + self.indices[gather]
+        counts = np.bincount(np.unique(pairs) % self.n_tools, minlength=self.n_tools)
+        return counts / self.vocab_sizes
+
+
+class ToolIndex:
+    """Precompiled schema heuristics for a tool list, keyed by its fingerprint."""
+
+    def __init__(self, tools, fingerprint=None):
+        self.tools = list(tools)
+        self.fingerprint = fingerprint or _tools_fingerprint(tools)
+        self.by_name = {t["name"]: t for t in self.tools}
+        self.entry_list = [_ToolEntry(t) for t in self.tools]
+        self.entries = {e.name: e for e in self.entry_list}
+        self._build_postings()
+        self.matrix = (
+            _ToolMatrix(self.entry_list)
+            if np is not None and len(self.tools) >= _TOOL_MATRIX_MIN_TOOLS else None
+        )
+
+    def entry(self, name):
+        return self.entries.get(name)
+
+    def _build_postings(self):
+        """
+        Inverted index over relevance vocabularies, keyed by tool position.
+
+        exact:  word -> tools whose vocab contains it
+        prefix: p (len >= 3) -> tools with a vocab word of len >= 3 starting with p
+        Together they answer _words_similar(qw, tw) for every tw in one pass.
+        """
+        self.exact = {}
+        self.prefix = {}
+        for tid, entry in enumerate(self.entry_list):
+            for tw in entry.vocab:
+                self.exact.setdefault(tw, set()).add(tid)
+                for k in range(3, len(tw) + 1):
+                    self.prefix.setdefault(tw[:k], set()).add(tid)
+
+    def _matching_tools(self, qw):
+        """Tool ids with at least one vocab word similar to qw."""
+        hits = set(self.exact.get(qw, ()))
+        if len(qw) >= 3:
+            hits.update(self.prefix.get(qw, ()))  # qw is a prefix of tw
+            for k in range(3, len(qw)):           # tw is a prefix of qw
+                hits.update(self.exact.get(qw[:k], ()))
+        return hits
+
+    def scores(self, query_words):
+        """Relevance for every candidate tool sharing a term with the query.
+
+        Identical to _tool_relevance for each returned id; tools not returned score 0.
+        """
+        if self.matrix is not None:
+            dense = self.matrix.scores(query_words)
+            return {int(tid): float(dense[tid]) for tid in np.flatnonzero(dense)}
+        matches = {}
+        for qw in _expand_query(query_words):
+            for tid in self._matching_tools(qw):
+                matches[tid] = matches.get(tid, 0) + 1
+        return {
+            tid: m / max(len(self.entry_list[tid].vocab), 1)
+            for tid, m in matches.items()
+        }
+
+    def top_k(self, query_words, k):
+        """Top-k (tool, score) pairs, ties broken by tool order like a linear scan."""
+        if self.matrix is not None:
+            dense = self.matrix.scores(query_words)
+            hits = np.flatnonzero(dense)
+            ranked = hits[np.lexsort((hits, -dense[hits]))][:k]
+            return [(self.tools[tid], float(dense[tid])) for tid in ranked]
+        ranked = sorted(self.scores(query_words).items(), key=lambda kv: (-kv[1], kv[0]))
+        return [(self.tools[tid], score) for tid, score in ranked[:k]]
+
+
+_TOOL_INDEX_CACHE_SIZE = 32
+_tool_index_cache = OrderedDict()
+_tool_index_lock = threading.Lock()
+
+
+# Per-tool schema digests, memoized by dict identity and revalidated by
+# content: each entry keeps a deep copy of the schema it hashed, and a dict
+# that no longer equals its copy (edited in place) is hashed again.
+_TOOL_DIGEST_CACHE_SIZE = 4096
+_tool_digests = OrderedDict()  # id(tool) -> (tool, snapshot, digest); holding tool keeps its id valid
+_tool_digest_lock = threading.Lock()
+
+
+def _tool_digest(tool):
+    blob = json.dumps(tool, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(blob.encode("utf-8")).digest()
+
+
+def _tools_fingerprint(tools):
+    """Stable hash of a tool list's schemas (order-sensitive), from memoized per-tool digests."""
+    digests = []
+    missing = []
+    with _tool_digest_lock:
+        for tool in tools:
+            hit = _tool_digests.get(id(tool))
+            # Dict equality runs in C, far cheaper than json.dumps + SHA-1.
+            if hit is not None and hit[0] is tool and hit[1] == tool:
+                _tool_digests.move_to_end(id(tool))
+                digests.append(hit[2])
+            else:
+                missing.append(len(digests))
+                digests.append(None)
+    if missing:
+        fresh = [(tools[i], copy.deepcopy(tools[i]), _tool_digest(tools[i])) for i in missing]
+        with _tool_digest_lock:
+            for i, entry in zip(missing, fresh):
+                digests[i] = entry[2]
+                _tool_digests[id(entry[0])] = entry
+                _tool_digests.move_to_end(id(entry[0]))
+            while len(_tool_digests) > _TOOL_DIGEST_CACHE_SIZE:
+                _tool_digests.popitem(last=False)
+    return hashlib.sha1(b"".join(digests)).hexdigest()
+
+
+def _get_tool_index(tools):
+    """Return the cached ToolIndex for this tool list, building it on first use."""
+    fp = _tools_fingerprint(tools)
+    with _tool_index_lock:
+        index = _tool_index_cache.get(fp)
+        if index is not None:
+            _tool_index_cache.move_to_end(fp)
+            return index
+    index = ToolIndex(tools, fingerprint=fp)
+    with _tool_index_lock:
+        # Another thread may have built the same index meanwhile; keep the first.
+        index = _tool_index_cache.setdefault(fp, index)
+        _tool_index_cache.move_to_end(fp)
+        while len(_tool_index_cache) > _TOOL_INDEX_CACHE_SIZE:
+            _tool_index_cache.popitem(last=False)
+    return index
+
+
 # ---------------------------------------------------------------------------
 # Proper noun extraction (reused across full query and split parts)
 # ---------------------------------------------------------------------------
 
-def _extract_proper_nouns(text, strip_set=None, schema_words=None):
-    """Extract capitalized words (proper nouns) from text, skipping index 0."""
-    nouns = []
-    words = text.split()
-    for i, w in enumerate(words):
-        cleaned = w.strip('.,!?;:\'"()[]{}')
-        if not cleaned or i == 0 or not cleaned[0].isupper():
-            continue
-        if cleaned.isdigit() or cleaned.upper() in ("AM", "PM"):
-            continue
-        if strip_set and schema_words and _should_strip(cleaned.lower(), strip_set, schema_words):
-            continue
-        nouns.append(cleaned)
-    return nouns
+def _extract_proper_nouns(query, strip_set=None, schema_trie=None):
+    """Capitalized words (proper nouns) of the query, skipping index 0 and schema words."""
+    nouns = _as_query(query).proper_nouns
+    if strip_set and schema_trie is not None:
+        return [n for n in nouns if not _should_strip(n.lower(), strip_set, schema_trie)]
+    return list(nouns)
 
 
 # ---------------------------------------------------------------------------
 # Schema-driven argument extraction
 # ---------------------------------------------------------------------------
 
-def _build_strip_set(tool):
-    """Build a set of words to strip, using prefix matching against tool schema words."""
-    base = set(_STOP_WORDS)
-    schema_words = set()
-    for part in tool["name"].split("_"):
-        schema_words.add(part.lower())
-    for w in _tokenize(tool.get("description", "")):
-        schema_words.add(w)
-    for _pname, pschema in tool["parameters"].get("properties", {}).items():
-        for w in _tokenize(pschema.get("description", "")):
-            schema_words.add(w)
-    base |= schema_words
-    return base, schema_words
-
-
-def _should_strip(word_lower, strip_set, schema_words):
+def _should_strip(word_lower, strip_set, schema_trie):
     """Check if a word should be stripped — exact match OR prefix of a schema word."""
     if word_lower in strip_set:
         return True
-    if len(word_lower) >= 3:
-        for sw in schema_words:
-            if _words_similar(word_lower, sw):
-                return True
-    return False
+    return len(word_lower) >= 3 and schema_trie.has_similar(word_lower)
+
+
+# Marker-based string slots: (markers tried in order, end markers applied in order).
+_SLOT_MARKERS = {
+    "time": ((" at ",), ()),
+    "location": ((" in ", " at "), (" and ", ", ", " saying ")),
+    "content": ((" saying ", " that says "), (" and ", ", and ")),
+    "title": ((" about ", " to ", " called "), (" at ", " and ", ", ")),
+}
+# Order in which a string parameter's categories are tried; location comes
+# before name to avoid "City name" ambiguity.
+_SLOT_ORDER = ("time", "location", "name", "content", "title", "channel")
+# Slots whose value the following category may overwrite (e.g. a Slack
+# "thread_ts" is both time and content: "saying ..." beats "at 9 am").
+_PROVISIONAL_SLOTS = frozenset({"time"})
+# Params we should NEVER fill with "remaining text" because they require IDs/specifics
+_FILL_BLACKLIST = frozenset({
+    "channel", "id", "url", "uri", "email", "phone", "uuid", "database_id", "block_id", "page_id",
+})
+
+
+class _Slot:
+    """One typed extractor for a string parameter."""
+
+    __slots__ = ("kind", "markers", "end_markers", "use_context")
+
+    def __init__(self, kind, categories):
+        self.kind = kind
+        self.markers, self.end_markers = _SLOT_MARKERS.get(kind, ((), ()))
+        # Only person-type params take nouns from the parent query, so
+        # non-person params like "Song name" are not contaminated.
+        self.use_context = "person" in categories
+
+
+class _SlotState:
+    """Mutable per-run state shared by a plan's slots."""
+
+    __slots__ = ("local_nouns", "all_nouns", "pn_used", "content_pos")
+
+    def __init__(self, local_nouns, all_nouns, content_pos):
+        self.local_nouns = local_nouns
+        self.all_nouns = all_nouns
+        self.pn_used = set()
+        self.content_pos = content_pos
+
+
+def _slot_time(query, slot, state):
+    """Digits and AM/PM right after " at "."""
+    for prep in slot.markers:
+        idx = query.find(prep)
+        if idx >= 0:
+            after = query.text[idx + len(prep):]
+            time_parts = []
+            for tw in after.split():
+                tw_clean = tw.strip('.,!?;:')
+                if tw_clean and (tw_clean[0].isdigit() or tw_clean.upper() in ("AM", "PM")):
+                    time_parts.append(tw_clean)
+                elif time_parts:
+                    break
+            if time_parts:
+                return " ".join(time_parts)
+    return None
 
 
-def _extract_from_schema(user_text, tool, extra_nouns=None):
-    """
-    Extract arguments from the query using the tool's parameter schema.
-    Uses general English patterns — not tool-specific.
+def _slot_location(query, slot, state):
+    """Text after " in " / " at ", cut at the first end marker."""
+    for prep in slot.markers:
+        idx = query.find(prep)
+        if idx >= 0:
+            after = query.text[idx + len(prep):].strip()
+            for end_marker in slot.end_markers:
+                end_idx = after.lower().find(end_marker)
+                if end_idx >= 0:
+                    after = after[:end_idx]
+            cleaned_loc = after.strip('.,!?;:')
+            if cleaned_loc:
+                return cleaned_loc
+    return None
 
-    extra_nouns: proper nouns from the parent query (for pronoun resolution
-                 in split sub-queries like "send him a message").
-    """
-    props = tool["parameters"]["properties"]
-    required = tool["parameters"].get("required", [])
-    strip_set, schema_words = _build_strip_set(tool)
-
-    words = user_text.split()
-    lower_text = user_text.lower()
-    args = {}
-
-    # --- Phase 1: Extract integers ---
-    numbers = []
-    for w in words:
-        cleaned = w.strip('.,!?;:')
-        if cleaned.isdigit():
-            numbers.append(int(cleaned))
-    for w in words:
-        cleaned = w.strip('.,!?;:')
-        if ":" in cleaned:
-            parts_c = cleaned.split(":")
-            if len(parts_c) == 2 and parts_c[0].isdigit() and parts_c[1].isdigit():
-                numbers.extend([int(parts_c[0]), int(parts_c[1])])
-
-    int_params = [(k, v) for k, v in props.items() if v.get("type") == "integer"]
-    for i, (pname, _pschema) in enumerate(int_params):
-        args[pname] = abs(numbers[i]) if i < len(numbers) else 0
-
-    # --- Phase 2: Extract proper nouns (capitalized words not at start) ---
-    local_nouns = _extract_proper_nouns(user_text, strip_set, schema_words)
-    all_nouns = list(local_nouns)
-    if extra_nouns:
-        existing = {pn.lower() for pn in all_nouns}
-        for en in extra_nouns:
-            if en.lower() not in existing:
-                all_nouns.append(en)
-
-    pn_used = set()
-
-    # --- Phase 3: Extract string params by description category ---
-    str_params = [(k, v) for k, v in props.items() if v.get("type") == "string"]
-    content_marker_pos = len(user_text)
-
-    for pname, pschema in str_params:
-        desc = (pschema.get("description", "") + " " + pname).lower()
-
-        # 3a. TIME params
-        if any(kw in desc for kw in ["time", "when", "schedule"]):
-            for prep in [" at "]:
-                idx = lower_text.find(prep)
-                if idx >= 0:
-                    after = user_text[idx + len(prep):]
-                    time_parts = []
-                    for tw in after.split():
-                        tw_clean = tw.strip('.,!?;:')
-                        if tw_clean and (tw_clean[0].isdigit() or tw_clean.upper() in ("AM", "PM")):
-                            time_parts.append(tw_clean)
-                        elif time_parts:
-                            break
-                    if time_parts:
-                        args[pname] = " ".join(time_parts)
-                        continue
-
-        # 3b. LOCATION params (before name to avoid "City name" ambiguity)
-        if any(kw in desc for kw in ["location", "city", "place"]):
-            for prep in [" in ", " at "]:
-                idx = lower_text.find(prep)
-                if idx >= 0:
-                    after = user_text[idx + len(prep):].strip()
-                    for end_marker in [" and ", ", ", " saying "]:
-                        end_idx = after.lower().find(end_marker)
-                        if end_idx >= 0:
-                            after = after[:end_idx]
-                    cleaned_loc = after.strip('.,!?;:')
-                    if cleaned_loc:
-                        args[pname] = cleaned_loc
-                        break
-            if pname in args:
-                continue
 
-        # 3c. NAME/ENTITY params: use proper nouns
-        # Only use extra_nouns (cross-query context) for person-type params
-        # to avoid contaminating non-person params like "Song name".
-        if any(kw in desc for kw in ["name", "person", "contact", "recipient"]):
-            is_person = any(kw in desc for kw in ["person", "contact", "recipient"])
-            nouns_pool = all_nouns if is_person else local_nouns
-            for pn in nouns_pool:
-                if pn not in pn_used:
-                    args[pname] = pn
-                    pn_used.add(pn)
-                    break
-            if pname in args:
-                continue
+def _slot_name(query, slot, state):
+    """The first proper noun not already used by another param."""
+    nouns_pool = state.all_nouns if slot.use_context else state.local_nouns
+    for pn in nouns_pool:
+        if pn not in state.pn_used:
+            state.pn_used.add(pn)
+            return pn
+    return None
 
-        # 3d. CONTENT/MESSAGE params: text after "saying" / "that says"
-        if any(kw in desc for kw in ["content", "message", "text", "query"]):
-            for marker in [" saying ", " that says "]:
-                idx = lower_text.find(marker)
-                if idx >= 0:
-                    content_marker_pos = min(content_marker_pos, idx)
-                    after = user_text[idx + len(marker):].strip()
-                    for end_marker in [" and ", ", and "]:
-                        end_idx = after.lower().find(end_marker)
-                        if end_idx >= 0:
-                            after = after[:end_idx]
-                    cleaned_msg = after.strip('.,!?;:')
-                    if cleaned_msg:
-                        args[pname] = cleaned_msg
-                        break
-            if pname in args:
-                continue
 
-        # 3e. TITLE params: text after "about" or "to" (for tasks/reminders)
-        if any(kw in desc for kw in ["title", "subject", "topic"]):
-            for marker in [" about ", " to ", " called "]:
-                idx = lower_text.find(marker)
-                if idx >= 0:
-                    after = user_text[idx + len(marker):].strip()
-                    for end_marker in [" at ", " and ", ", "]:
-                        end_idx = after.lower().find(end_marker)
-                        if end_idx >= 0:
-                            after = after[:end_idx]
-                    for article in ["the ", "a ", "an "]:
-                        if after.lower().startswith(article):
-                            after = after[len(article):]
-                    cleaned_title = after.strip('.,!?;:')
-                    if cleaned_title:
-                        args[pname] = cleaned_title
-                        break
-            if pname in args:
-                continue
-        
-        # 3f. CHANNEL/MENTION params: words starting with # or @ (Slack specific but generic enough)
-        if any(kw in desc for kw in ["channel", "mention", "recipient"]):
-            for w in words:
-                cleaned = w.strip('.,!?;:')
-                if cleaned.startswith("#") or cleaned.startswith("@"):
-                     args[pname] = cleaned
-                     break
-            if pname in args:
-                continue
+def _slot_content(query, slot, state):
+    """Text after "saying" / "that says"; also bounds the leftover-text scan."""
+    for marker in slot.markers:
+        idx = query.find(marker)
+        if idx >= 0:
+            state.content_pos = min(state.content_pos, idx)
+            after = query.text[idx + len(marker):].strip()
+            for end_marker in slot.end_markers:
+                end_idx = after.lower().find(end_marker)
+                if end_idx >= 0:
+                    after = after[:end_idx]
+            cleaned_msg = after.strip('.,!?;:')
+            if cleaned_msg:
+                return cleaned_msg
+    return None
 
-    # --- Phase 4: Fill remaining unfilled string params with leftover text ---
-    # Only use words BEFORE any content marker ("saying", "that says") to avoid
-    # leaking message content into other params like recipient.
-    text_for_remaining = user_text[:content_marker_pos]
-    remaining = []
-    last_kept = False
 
-    for w in text_for_remaining.split():
-        cleaned = w.strip('.,!?;:\'"()[]{}').lower()
-        
-        should_strip = _should_strip(cleaned, strip_set, schema_words)
-        is_digit = cleaned.isdigit()
-        is_pn = cleaned in [pn.lower() for pn in pn_used]
-        is_time = cleaned.upper() in ("AM", "PM")
-        
-        keep = False
-        if cleaned and not is_digit and not is_pn and not is_time:
-            if not should_strip:
-                keep = True
-            elif last_kept:
-                # Heuristic: keep schema word if it extends a phrase (e.g. "classical music")
-                keep = True
-        
-        if keep:
-            raw = w.strip('.,!?;:')
-            if ":" in raw and all(p.isdigit() for p in raw.split(":")):
-                pass
+def _slot_title(query, slot, state):
+    """Text after "about" / "to" / "called" (for tasks/reminders), minus a leading article."""
+    for marker in slot.markers:
+        idx = query.find(marker)
+        if idx >= 0:
+            after = query.text[idx + len(marker):].strip()
+            for end_marker in slot.end_markers:
+                end_idx = after.lower().find(end_marker)
+                if end_idx >= 0:
+                    after = after[:end_idx]
+            for article in ["the ", "a ", "an "]:
+                if after.lower().startswith(article):
+                    after = after[len(article):]
+            cleaned_title = after.strip('.,!?;:')
+            if cleaned_title:
+                return cleaned_title
+    return None
+
+
+def _slot_channel(query, slot, state):
+    """The first word starting with # or @ (Slack specific but generic enough)."""
+    for cleaned in query.trimmed:
+        if cleaned.startswith("#") or cleaned.startswith("@"):
+            return cleaned
+    return None
+
+
+_SLOT_EXTRACTORS = {
+    "time": _slot_time,
+    "location": _slot_location,
+    "name": _slot_name,
+    "content": _slot_content,
+    "title": _slot_title,
+    "channel": _slot_channel,
+}
+
+
+class ExtractionPlan:
+    """
+    A tool's schema extraction compiled once: integer params filled from the
+    query's numbers, an ordered list of typed slots per string param, and
+    the params allowed to take leftover text. run() executes it against a
+    QueryAnalysis using general English patterns — not tool-specific.
+    """
+
+    __slots__ = ("name", "required", "int_params", "str_slots", "fillable", "strip_set", "strip_trie")
+
+    def __init__(self, entry):
+        self.name = entry.name
+        self.required = tuple(entry.required)
+        self.int_params = tuple(pname for pname, _ in entry.int_params)
+        self.str_slots = tuple(
+            (pname, tuple(
+                _Slot(kind, entry.categories[pname])
+                for kind in _SLOT_ORDER if kind in entry.categories[pname]
+            ))
+            for pname, _ in entry.str_params
+        )
+        self.fillable = tuple(pname for pname, _ in entry.str_params if pname.lower() not in _FILL_BLACKLIST)
+        self.strip_set, self.strip_trie = entry.strip_set, entry.strip_trie
+
+    def run(self, query, extra_nouns=None):
+        """Arguments extracted for this tool as a call dict, or None if a required one is missing."""
+        strip_set, schema_trie = self.strip_set, self.strip_trie
+        args = {}
+
+        # --- Phase 1: Extract integers (digits, then clock-time parts) ---
+        numbers = query.numbers
+        for i, pname in enumerate(self.int_params):
+            args[pname] = abs(numbers[i]) if i < len(numbers) else 0
+
+        # --- Phase 2: Extract proper nouns (capitalized words not at start) ---
+        local_nouns = _extract_proper_nouns(query, strip_set, schema_trie)
+        all_nouns = list(local_nouns)
+        if extra_nouns:
+            existing = {pn.lower() for pn in all_nouns}
+            for en in extra_nouns:
+                if en.lower() not in existing:
+                    all_nouns.append(en)
+        state = _SlotState(local_nouns, all_nouns, len(query.text))
+
+        # --- Phase 3: String params by category, in _SLOT_ORDER ---
+        # A time value is provisional: the param's next category still runs
+        # (and may replace it), after which the param is settled either way.
+        for pname, slots in self.str_slots:
+            for slot in slots:
+                value = _SLOT_EXTRACTORS[slot.kind](query, slot, state)
+                if value:
+                    args[pname] = value
+                if pname in args and slot.kind not in _PROVISIONAL_SLOTS:
+                    break
+
+        # --- Phase 4: Fill remaining unfilled string params with leftover text ---
+        # Only use words BEFORE any content marker ("saying", "that says") to avoid
+        # leaking message content into other params like recipient. Markers start
+        # with a space, so the cut falls on a word boundary.
+        n_words = query.words_before(state.content_pos)
+        pn_used_lower = {pn.lower() for pn in state.pn_used}
+        remaining = []
+        last_kept = False
+
+        for cleaned, raw in zip(query.clean_lower[:n_words], query.trimmed[:n_words]):
+            should_strip = _should_strip(cleaned, strip_set, schema_trie)
+            is_digit = cleaned.isdigit()
+            is_pn = cleaned in pn_used_lower
+            is_time = cleaned.upper() in ("AM", "PM")
+
+            keep = False
+            if cleaned and not is_digit and not is_pn and not is_time:
+                if not should_strip:
+                    keep = True
+                elif last_kept:
+                    # Heuristic: keep schema word if it extends a phrase (e.g. "classical music")
+                    keep = True
+
+            if keep:
+                if ":" in raw and all(p.isdigit() for p in raw.split(":")):
+                    pass
+                else:
+                    remaining.append(raw)
+                last_kept = True
             else:
-                remaining.append(raw)
-            last_kept = True
-        else:
-            last_kept = False
+                last_kept = False
 
-    remaining_text = " ".join(remaining).strip()
-    
-    # Params we should NEVER fill with "remaining text" because they require IDs/specifics
-    BLACKLIST_PARAMS = {"channel", "id", "url", "uri", "email", "phone", "uuid", "database_id", "block_id", "page_id"}
+        remaining_text = " ".join(remaining).strip()
+        if remaining_text:
+            for pname in self.fillable:
+                if pname not in args:
+                    args[pname] = remaining_text
+                    break
 
-    for pname, _pschema in str_params:
-        if pname not in args and remaining_text:
-            if pname.lower() in BLACKLIST_PARAMS:
-                continue
-            args[pname] = remaining_text
-            remaining_text = ""
+        if all(r in args and _is_valid_arg(args[r]) for r in self.required):
+            return {"name": self.name, "arguments": args}
+        return None
 
-    if all(r in args and _is_valid_arg(args[r]) for r in required):
-        return {"name": tool["name"], "arguments": args}
-    return None
+
+def _extract_from_schema(query, tool, extra_nouns=None, entry=None):
+    """
+    Extract arguments from the query using the tool's compiled ExtractionPlan.
+
+    extra_nouns: proper nouns from the parent query (for pronoun resolution
+                 in split sub-queries like "send him a message").
+    entry: precomputed _ToolEntry from a ToolIndex (built on the fly if None).
+    """
+    entry = entry or _ToolEntry(tool)
+    return entry.plan.run(_as_query(query), extra_nouns)
 
 
-def _best_extract_all_tools(user_text, tools, extra_nouns=None):
+def _best_extract_all_tools(query, tools, extra_nouns=None, index=None):
     """
     Try schema extraction for ALL available tools and pick the one whose
     extracted arguments best match the query text (by overlap score).
     """
+    query = _as_query(query)
+    index = index or _get_tool_index(tools)
     best_call = None
     best_score = 0
     for t in tools:
-        ext = _extract_from_schema(user_text, t, extra_nouns=extra_nouns)
+        ext = _extract_from_schema(query, t, extra_nouns=extra_nouns, entry=index.entry(t["name"]))
         if ext:
             _coerce_argument_types([ext], [t])
             valid = _filter_valid_calls([ext], [t])
             if valid:
-                score = _arg_query_overlap(valid, user_text, [t], extra_nouns=extra_nouns)
+                score = _arg_query_overlap(valid, query, [t], extra_nouns=extra_nouns)
                 if score > best_score:
                     best_score = score
                     best_call = valid[0]
     return best_call, best_score
 
 
-def _maybe_prefer_schema(calls, user_text, tools, extra_nouns=None):
+def _maybe_prefer_schema(calls, query, tools, extra_nouns=None, index=None):
     """
     For each model-returned call, also run schema extraction for the SAME tool
     and pick whichever has better argument-query overlap. Zero-cost (no model call).
     """
+    query = _as_query(query)
     improved = []
     for call in calls:
-        tool = next((t for t in tools if t["name"] == call["name"]), None)
+        tool = next((t for t in tools if t["name"] == call.name), None)
         if not tool:
             improved.append(call)
             continue
-        schema_alt = _extract_from_schema(user_text, tool, extra_nouns=extra_nouns)
+        entry = index.entry(tool["name"]) if index else None
+        schema_alt = _extract_from_schema(query, tool, extra_nouns=extra_nouns, entry=entry)
         if schema_alt:
             _coerce_argument_types([schema_alt], [tool])
             alt_valid = _filter_valid_calls([schema_alt], [tool])
             if alt_valid:
-                m_score = _arg_query_overlap([call], user_text, tools, extra_nouns=extra_nouns)
-                s_score = _arg_query_overlap(alt_valid, user_text, [tool], extra_nouns=extra_nouns)
+                m_score = _arg_query_overlap([call], query, tools, extra_nouns=extra_nouns)
+                s_score = _arg_query_overlap(alt_valid, query, [tool], extra_nouns=extra_nouns)
                 if s_score > m_score:
-                    _diag(f"schema-improve: {call['name']} model_score={m_score} schema_score={s_score}")
+                    _diag("schema-improve: %s model_score=%s schema_score=%s", call.name, m_score, s_score)
                     improved.append(alt_valid[0])
                     continue
         improved.append(call)
     return improved
 
 
+# ---------------------------------------------------------------------------
+# Schema grammar — constrain FunctionGemma decoding to valid calls
+# ---------------------------------------------------------------------------
+
+# No current cactus binding takes a `grammar` argument (_ENGINE_GRAMMAR is
+# False), so compiled grammars are only passed once the engine accepts them.
+_GRAMMAR_DECODE = True
+_GRAMMAR_CACHE_SIZE = 32
+_grammar_cache = OrderedDict()
+_grammar_lock = threading.Lock()
+
+_GBNF_TYPE_RULES = {"string": "str", "integer": "int", "number": "num", "boolean": "bool"}
+_GBNF_COMMON = (
+    'str ::= "<escape>" [^<]* "<escape>"\n'
+    'int ::= "-"? [0-9]+\n'
+    'num ::= "-"? [0-9]+ ("." [0-9]+)?\n'
+    'bool ::= "true" | "false"\n'
+    'key ::= [a-zA-Z0-9_]+\n'
+    'any ::= str | num | bool | "[" (any ("," any)*)? "]" | "{" (key ":" any ("," key ":" any)*)? "}"\n'
+)
+
+
+def _gbnf_literal(text):
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _gbnf_value(pschema):
+    """Value rule for one parameter: enum alternatives, a scalar type, or `any`."""
+    enum = pschema.get("enum")
+    if enum and all(isinstance(v, str) for v in enum):
+        return "(" + " | ".join(f'"<escape>" {_gbnf_literal(v)} "<escape>"' for v in enum) + ")"
+    return _GBNF_TYPE_RULES.get(pschema.get("type"), "any")
+
+
+def _compile_tool_grammar(tools):
+    """
+    GBNF grammar for FunctionGemma's native call syntax over `tools`:
+    <start_function_call>call:NAME{key:value,...}<end_function_call>, one or
+    more times. Only declared tool names are allowed; required keys come
+    first in schema order, then optional keys; each value has the shape of
+    its JSON type (strings are <escape>-delimited).
+    """
+    lines = []
+    alternatives = []
+    for i, tool in enumerate(tools):
+        rule = f"tool-{i}"
+        alternatives.append(rule)
+        props = tool.get("parameters", {}).get("properties", {})
+        required = [k for k in tool.get("parameters", {}).get("required", []) if k in props]
+        optional = [k for k in props if k not in required]
+        pairs = {k: f"{_gbnf_literal(k + ':')} {_gbnf_value(props[k])}" for k in props}
+        if required:
+            args = ' "," '.join(pairs[k] for k in required)
+            args += "".join(f' ("," {pairs[k]})?' for k in optional)
+        elif optional:
+            one = "(" + " | ".join(pairs[k] for k in optional) + ")"
+            args = f'({one} ("," {one})*)?'
+        else:
+            args = ""
+        body = [_gbnf_literal(tool["name"] + "{"), args, '"}"']
+        lines.append(f"{rule} ::= " + " ".join(part for part in body if part))
+    head = [
+        "root ::= call+",
+        'call ::= "<start_function_call>call:" (' + " | ".join(alternatives) + ') "<end_function_call>"',
+    ]
+    return "\n".join(head + lines) + "\n" + _GBNF_COMMON
+
+
+def _tool_grammar(tools, fingerprint):
+    """Compiled grammar for a tool list, memoized by its fingerprint."""
+    with _grammar_lock:
+        grammar = _grammar_cache.get(fingerprint)
+        if grammar is not None:
+            _grammar_cache.move_to_end(fingerprint)
+            return grammar
+    grammar = _compile_tool_grammar(tools)
+    with _grammar_lock:
+        _grammar_cache[fingerprint] = grammar
+        while len(_grammar_cache) > _GRAMMAR_CACHE_SIZE:
+            _grammar_cache.popitem(last=False)
+    return grammar
+
+
 # ---------------------------------------------------------------------------
 # Cactus inference primitives
 # ---------------------------------------------------------------------------
@@ -653,43 +1586,656 @@ def _post_process_args(function_calls):
         "blues", "soul", "funk", "disco", "techno", "house",
         "lo-fi", "hip hop", "hip-hop"
     }
+    processed = []
     for call in function_calls:
-        if call["name"] == "play_music":
-            song = call["arguments"].get("song")
+        if call.name == "play_music":
+            song = call.arguments.get("song")
             if song and isinstance(song, str):
                 # Fix "jazz music" -> "jazz"
                 if song.lower().endswith(" music"):
                     prefix = song[:-6].strip()
                     if prefix.lower() in STRONG_GENRES:
-                        call["arguments"]["song"] = prefix
-    return function_calls
+                        call = call.with_arguments(song=prefix)
+        processed.append(call)
+    return processed
 
 
-def _cactus_attempt(model, messages, cactus_tools, **overrides):
-    """Run one cactus_complete call with JSON repair."""
-    raw_str = cactus_complete(
-        model,
-        messages,
-        tools=cactus_tools,
-        force_tools=True,
-        max_tokens=overrides.get("max_tokens", 512),
-        stop_sequences=["<|im_end|>", "<end_of_turn>"],
-        tool_rag_top_k=overrides.get("tool_rag_top_k", 0),
-        confidence_threshold=0.0,
-        temperature=overrides.get("temperature"),
-    )
-    return _repair_and_parse(raw_str)
+_MAX_TOKENS = 512
+_MIN_TOKENS = 48
+_TOKEN_SLACK = 1.5
+_STREAM_DECODE = True
+_FG_ESCAPE = "<escape>"
+_FG_START_CALL = "<start_function_call>"
+_FG_END_CALL = "<end_function_call>"
 
 
-def _get_ms(raw):
-    return (raw or {}).get("total_time_ms", 0) or 0
+def _generation_budget(entries, expected_calls=1):
+    """
+    max_tokens for an attempt over these tools: the costliest call times the
+    expected call count, with slack, clamped to [_MIN_TOKENS, _MAX_TOKENS].
+    """
+    if not entries:
+        return _MAX_TOKENS
+    per_call = max(e.call_tokens for e in entries)
+    return max(_MIN_TOKENS, min(_MAX_TOKENS, int(per_call * expected_calls * _TOKEN_SLACK)))
+
+
+_LENGTH_STOPS = frozenset({"length", "max_tokens"})
+
+
+def _truncated(raw, max_tokens):
+    """
+    Whether an attempt hit its max_tokens cap before finishing: it decoded the
+    full cap, or the engine reports a length stop. Unparseable output (None)
+    is not evidence of truncation, so it never earns a retry.
+    """
+    if raw is None or raw.get("early_stop"):
+        return False
+    if str(raw.get("stop_reason") or raw.get("finish_reason") or "").lower() in _LENGTH_STOPS:
+        return True
+    decoded = raw.get("decode_tokens")
+    return decoded is not None and decoded >= max_tokens
+
+
+def _engine_accepts(param):
+    """True if this cactus build's cactus_complete takes keyword `param`."""
+    try:
+        return param in inspect.signature(cactus_complete).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+# Token callbacks + cactus_stop allow early-stopped streaming decode; a
+# grammar argument allows schema-constrained decoding (logit masking).
+_ENGINE_STREAMS = cactus_stop is not None and _engine_accepts("callback")
+_ENGINE_GRAMMAR = _engine_accepts("grammar")
+
+
+class _CallStreamTracker:
+    """
+    Incremental scan of streamed FunctionGemma output that detects the end of
+    the call list: an <end_function_call> followed by anything other than
+    another <start_function_call>. The model's own output decides (no guessed
+    call count); markers inside <escape>-delimited strings are ignored and
+    markers split across tokens are still found.
+    """
+
+    __slots__ = ("complete", "in_escape", "tail", "after_call", "done")
+
+    def __init__(self):
+        self.complete = 0        # calls closed so far
+        self.in_escape = False
+        self.tail = ""           # unconsumed text that may start a marker
+        self.after_call = False  # a call just closed; waiting for what follows
+        self.done = False
+
+    def feed(self, text):
+        """Consume one streamed piece; True once the call list is finished."""
+        for i, segment in enumerate(text.split(_FG_ESCAPE)):
+            if self.done:
+                break
+            if i:
+                if self.after_call:
+                    # A string right after a closed call is not another call.
+                    self.done = True
+                    break
+                self.in_escape = not self.in_escape
+                self.tail = ""
+            if not self.in_escape:
+                self._scan(segment)
+        return self.done
+
+    def _scan(self, segment):
+        buf = self.tail + segment
+        self.tail = ""
+        while buf:
+            if self.after_call:
+                rest = buf.lstrip()
+                if not rest:
+                    return
+                if rest.startswith(_FG_START_CALL):
+                    self.after_call = False
+                    buf = rest[len(_FG_START_CALL):]
+                    continue
+                if _FG_START_CALL.startswith(rest):
+                    self.tail = rest  # may still become <start_function_call>
+                    return
+                self.done = True
+                return
+            idx = buf.find(_FG_END_CALL)
+            if idx < 0:
+                # Keep just enough to complete a marker that continues in the next piece.
+                self.tail = buf[-(len(_FG_END_CALL) - 1):]
+                return
+            self.complete += 1
+            self.after_call = True
+            buf = buf[idx + len(_FG_END_CALL):]
+
+
+def _cactus_attempt(model, messages, cactus_tools, **overrides):
+    """
+    Run one cactus_complete call with JSON repair.
+
+    When the engine streams tokens, generation is stopped as soon as the
+    model's call list is finished (see _CallStreamTracker). If the
+    parsed output then holds function calls, the result is flagged
+    "early_stop" with the unused part of max_tokens as "tokens_saved".
+    """
+    max_tokens = overrides.get("max_tokens", _MAX_TOKENS)
+    kwargs = {}
+    tracker = None
+    if _STREAM_DECODE and _ENGINE_STREAMS:
+        tracker = _CallStreamTracker()
+        seen = [0]
+
+        def on_token(token, token_id=None):
+            seen[0] += 1
+            if not tracker.done and tracker.feed(token or ""):
+                cactus_stop(model)
+
+        kwargs["callback"] = on_token
+    if overrides.get("grammar"):
+        kwargs["grammar"] = overrides["grammar"]
+
+    raw_str = cactus_complete(
+        model,
+        messages,
+        tools=cactus_tools,
+        force_tools=True,
+        max_tokens=max_tokens,
+        stop_sequences=["<|im_end|>", "<end_of_turn>"],
+        tool_rag_top_k=overrides.get("tool_rag_top_k", 0),
+        confidence_threshold=0.0,
+        temperature=overrides.get("temperature"),
+        **kwargs,
+    )
+    raw = _repair_and_parse(raw_str)
+    # Only a stop that left parseable calls behind counts; otherwise let
+    # _truncated see the capped run and retry it.
+    if tracker is not None and tracker.done and isinstance(raw, dict) and raw.get("function_calls"):
+        raw["early_stop"] = True
+        raw["tokens_saved"] = max(0, max_tokens - seen[0])
+    return raw
+
+
+def _tokens_saved(raw):
+    return (raw or {}).get("tokens_saved", 0) or 0
+
+
+def _run_attempt(model, prefix_messages, messages, cactus_tools, tools_fp, max_tokens,
+                 budget=None, stage="attempt", **overrides):
+    """
+    Reset `model` to the prefix and run one attempt capped at max_tokens; if
+    the output was truncated, retry once at _MAX_TOKENS unless `budget` has
+    no room for another `stage` run. Model time of both runs is summed into
+    the returned total_time_ms. Where the engine takes a grammar, decoding is
+    constrained to valid calls over cactus_tools.
+    """
+    if _GRAMMAR_DECODE and _ENGINE_GRAMMAR:
+        overrides["grammar"] = _tool_grammar([t["function"] for t in cactus_tools], tools_fp)
+    _reset_to_prefix(model, prefix_messages, cactus_tools, tools_fp)
+    raw = _cactus_attempt(model, prefix_messages + messages, cactus_tools, max_tokens=max_tokens, **overrides)
+    if max_tokens >= _MAX_TOKENS or not _truncated(raw, max_tokens):
+        return raw
+    if budget is not None and not budget.allows(stage + "_retry", _stage_latency.estimate(stage)):
+        return raw
+    _diag("attempt TRUNCATED at max_tokens=%d, retrying at %d", max_tokens, _MAX_TOKENS, level=_INFO)
+    first_ms = _get_ms(raw)
+    _reset_to_prefix(model, prefix_messages, cactus_tools, tools_fp)
+    raw = _cactus_attempt(model, prefix_messages + messages, cactus_tools, max_tokens=_MAX_TOKENS, **overrides)
+    if raw is not None:
+        raw["total_time_ms"] = _get_ms(raw) + first_ms
+        raw["truncation_retry"] = True
+    return raw
+
+
+def _get_ms(raw):
+    return (raw or {}).get("total_time_ms", 0) or 0
+
+
+def _split_intents(user_text):
+    """Split a multi-intent query on conjunctions/commas into candidate parts."""
+    parts = re.split(r'\s+and\s+|,\s*and\s+|,\s+', user_text)
+    return [p.strip() for p in parts if len(p.strip()) > 5]
+
+
+# ---------------------------------------------------------------------------
+# Rule-first fast path — skip FunctionGemma when schema extraction is clear
+# ---------------------------------------------------------------------------
+
+# Minimum relevance gap between the top tool and the runner-up.
+_RULE_FIRST_MARGIN = 0.25
+
+
+def _rule_first_call(query, tools, index, margin=_RULE_FIRST_MARGIN):
+    """
+    Return a schema-extracted result without running the model, or None.
+
+    Accepted only when (a) the top tool leads the runner-up by at least
+    `margin` relevance, (b) every required argument is filled, and
+    (c) the arguments have positive overlap with the query text.
+    """
+    start = time.perf_counter()
+    query = _as_query(query)
+    ranked = index.top_k(query.token_set, 2)
+    if not ranked or ranked[0][1] <= 0.05:
+        return None
+    tool, top_score = ranked[0]
+    gap = top_score - (ranked[1][1] if len(ranked) > 1 else 0.0)
+    if gap < margin:
+        _diag("rule-first SKIP: %s gap=%.2f < %.2f", tool["name"], gap, margin)
+        return None
+
+    ext = _extract_from_schema(query, tool, entry=index.entry(tool["name"]))
+    if not ext:
+        _diag("rule-first SKIP: %s missing required args", tool["name"])
+        return None
+    _coerce_argument_types([ext], [tool])
+    valid = _filter_valid_calls([ext], [tool])
+    overlap = _arg_query_overlap(valid, query, [tool]) if valid else 0
+    if overlap <= 0:
+        _diag("rule-first SKIP: %s overlap=%s", tool["name"], overlap)
+        return None
+
+    _diag("rule-first OK: %s gap=%.2f overlap=%s", _Json(valid), gap, overlap, level=_INFO)
+    return {
+        "function_calls": _post_process_args(valid),
+        "total_time_ms": (time.perf_counter() - start) * 1000,
+        "confidence": 0.5,
+        "source": "on-device (rules)",
+    }
+
+
+# ---------------------------------------------------------------------------
+# Result cache — LRU + TTL over validated calls, keyed by text + tool set
+# ---------------------------------------------------------------------------
+
+class _ResultCache:
+    """
+    Bounded LRU cache of validated function calls with per-entry TTL.
+
+    Keys embed the tool-set fingerprint, so any change to the tool list
+    (names, descriptions or parameters) misses and old entries age out. Hits
+    are also re-validated against the caller's tools; an entry with no call
+    still valid for them is dropped and counts as a miss.
+    """
+
+    def __init__(self, max_size=256, ttl_s=3600.0):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, tools):
+        start = time.perf_counter()
+        with self._lock:
+            item = self._entries.get(key)
+            calls = None
+            if item is not None:
+                expired = time.monotonic() - item["stored_at"] > self.ttl_s
+                calls = None if expired else _filter_valid_calls(item["function_calls"], tools)
+                if not calls:
+                    del self._entries[key]
+            if not calls:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return {
+            "function_calls": calls,
+            "total_time_ms": (time.perf_counter() - start) * 1000,
+            "confidence": item["confidence"],
+            "source": "on-device (cache)",
+            "cached_source": item["source"],
+        }
+
+    def put(self, key, result, tools):
+        """Store only calls that validate against the current tool list."""
+        calls = _filter_valid_calls(result.get("function_calls") or [], tools)
+        if not calls:
+            return
+        with self._lock:
+            self._entries[key] = {
+                "function_calls": calls,
+                "confidence": result.get("confidence", 0),
+                "source": result.get("source", "unknown"),
+                "stored_at": time.monotonic(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_result_cache = _ResultCache()
+
+
+def _normalize_query(text):
+    """
+    Collapse whitespace and drop trailing punctuation. Case is kept: cached
+    arguments are case-sensitive ("Call ME" must not answer "call me").
+    """
+    return " ".join(text.split()).rstrip(".!?")
+
+
+def _result_cache_key(user_text, index):
+    return (_normalize_query(user_text), index.fingerprint)
+
+
+def result_cache_stats():
+    """Hit/miss counters and occupancy of the generate_hybrid result caches."""
+    stats = _result_cache.stats()
+    stats["semantic"] = _semantic_cache.stats()
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# Semantic cache — reuse the tool choice for paraphrased queries
+# ---------------------------------------------------------------------------
+
+_SEMANTIC_CACHE = True
+_SEMANTIC_THRESHOLD = 0.92
+
+
+def _embed_query(text):
+    """Unit-norm query embedding from the loaded FunctionGemma model, or None."""
+    try:
+        with get_cactus_pool().context() as model:
+            vec = np.asarray(cactus_embed(model, text), dtype=np.float32)
+    except Exception as e:
+        _diag("semantic embed FAIL: %s", e, level=_WARNING)
+        return None
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if vec.ndim == 1 and norm > 0 else None
+
+
+class _SemanticCache:
+    """
+    Bounded ring of query embeddings, each remembering the single tool that
+    answered it. Lookup is one mat-vec over the rows sharing the caller's
+    tool-set fingerprint; arguments are always re-extracted from the new
+    query, so only the tool choice is reused.
+    """
+
+    def __init__(self, max_size=512, threshold=_SEMANTIC_THRESHOLD):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._matrix = None          # (max_size, dim) float32, rows unit-norm
+        self._rows = []              # (fingerprint, tool_name, source) per row
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return _SEMANTIC_CACHE and cactus_embed is not None and np is not None
+
+    def lookup(self, vec, fingerprint):
+        """Return (tool_name, similarity) of the nearest cached query, or None."""
+        with self._lock:
+            n = len(self._rows)
+            if vec is None or n == 0 or self._matrix.shape[1] != vec.shape[0]:
+                self.misses += 1
+                return None
+            sims = self._matrix[:n] @ vec
+            same_tools = np.fromiter((r[0] == fingerprint for r in self._rows), dtype=bool, count=n)
+            sims = np.where(same_tools, sims, -1.0)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._rows[best][1], float(sims[best])
+
+    def add(self, vec, fingerprint, tool_name, source):
+        with self._lock:
+            if vec is None:
+                return
+            if self._matrix is None or self._matrix.shape[1] != vec.shape[0]:
+                self._matrix = np.zeros((self.max_size, vec.shape[0]), dtype=np.float32)
+                self._rows = []
+                self._next = 0
+            row = (fingerprint, tool_name, source)
+            self._matrix[self._next] = vec
+            if self._next < len(self._rows):
+                self._rows[self._next] = row
+            else:
+                self._rows.append(row)
+            self._next = (self._next + 1) % self.max_size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._rows),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_semantic_cache = _SemanticCache()
+
+
+def _semantic_cache_call(query, vec, index):
+    """Re-extract arguments for the cached tool of a paraphrased query."""
+    start = time.perf_counter()
+    found = _semantic_cache.lookup(vec, index.fingerprint)
+    if not found:
+        return None
+    tool_name, sim = found
+    tool = index.by_name.get(tool_name)
+    ext = _extract_from_schema(query, tool, entry=index.entry(tool_name)) if tool else None
+    if not ext:
+        _diag("semantic HIT %s sim=%.3f but extraction failed", tool_name, sim)
+        return None
+    _coerce_argument_types([ext], [tool])
+    valid = _filter_valid_calls([ext], [tool])
+    if not valid or _arg_query_overlap(valid, query, [tool]) <= 0:
+        _diag("semantic HIT %s sim=%.3f but arguments rejected", tool_name, sim)
+        return None
+    _diag("semantic HIT: %s sim=%.3f", _Json(valid), sim, level=_INFO)
+    return {
+        "function_calls": _post_process_args(valid),
+        "total_time_ms": (time.perf_counter() - start) * 1000,
+        "confidence": 0.5,
+        "source": "on-device (semantic cache)",
+        "similarity": sim,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Latency budget — skip or shorten stages that would overrun a deadline
+# ---------------------------------------------------------------------------
+
+# Starting estimates (wall ms) until real observations come in.
+_STAGE_PRIORS_MS = {"attempt1": 150.0, "attempt2": 120.0, "split_part": 150.0, "cloud": 900.0}
+# Below this much remaining budget the cloud call is skipped, not shortened.
+_CLOUD_MIN_BUDGET_MS = 250.0
+# Cloud errors that mean "out of time" under a deadline; anything else is a
+# real failure and propagates as it does without one.
+CLOUD_TIMEOUT_ERRORS = (TimeoutError, _FutureTimeout, _FutureCancelled, asyncio.TimeoutError) + (
+    (httpx.TimeoutException,) if httpx is not None else ()
+)
+
+
+class _StageLatency:
+    """Exponentially weighted moving average of observed wall time per stage."""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._ms = dict(_STAGE_PRIORS_MS)
+        self._lock = threading.Lock()
+
+    def observe(self, stage, ms):
+        with self._lock:
+            prev = self._ms.get(stage)
+            self._ms[stage] = ms if prev is None else (1 - self.alpha) * prev + self.alpha * ms
+
+    def estimate(self, stage):
+        with self._lock:
+            return self._ms.get(stage, 0.0)
+
+
+_stage_latency = _StageLatency()
+
+
+class _Budget:
+    """End-to-end deadline for one request; deadline_ms=None never cuts anything."""
+
+    def __init__(self, deadline_ms=None):
+        self.deadline_ms = deadline_ms
+        self.start = time.perf_counter()
+        self.cut = []
+
+    @property
+    def limited(self):
+        return self.deadline_ms is not None
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def remaining_ms(self):
+        if self.deadline_ms is None:
+            return float("inf")
+        return self.deadline_ms - self.elapsed_ms()
+
+    def allows(self, stage, cost_ms=None):
+        """True if `stage` (expected to take cost_ms) still fits; otherwise record the cut."""
+        if self.deadline_ms is None:
+            return True
+        need = _stage_latency.estimate(stage) if cost_ms is None else cost_ms
+        remaining = self.remaining_ms()
+        if remaining >= need:
+            return True
+        self.cut.append(stage)
+        _diag("budget CUT %s: need~%.0fms, remaining %.0fms", stage, need, remaining, level=_INFO)
+        return False
+
+    def report(self):
+        return {
+            "deadline_ms": self.deadline_ms,
+            "elapsed_ms": self.elapsed_ms(),
+            "remaining_ms": self.remaining_ms(),
+            "cut": list(self.cut),
+        }
+
+
+# ---------------------------------------------------------------------------
+# Tracing — timed spans per pipeline stage
+# ---------------------------------------------------------------------------
+
+class Trace:
+    """
+    Per-request record of pipeline stages. Each span carries the stage name,
+    start offset and wall time (ms), plus whatever the stage sets on it:
+    model-reported model_ms, prefill/decode token counts, outcome, part, ...
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.tags = {}
+        self._lock = threading.Lock()
+
+    def tagged(self, **tags):
+        """A view of this trace that adds `tags` to every span it records."""
+        view = copy.copy(self)
+        view.tags = {**self.tags, **tags}
+        return view
+
+    def add(self, stage, t0, t1, **attrs):
+        """Record a span measured elsewhere (perf_counter start/end)."""
+        span = {
+            "stage": stage,
+            "start_ms": (t0 - self.start) * 1000,
+            "wall_ms": (t1 - t0) * 1000,
+            **self.tags,
+            **attrs,
+        }
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        span = dict(attrs)
+        t0 = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.setdefault("outcome", f"error: {type(e).__name__}")
+            raise
+        finally:
+            self.add(stage, t0, time.perf_counter(), **span)
+
+    def export(self):
+        """Spans as plain dicts, ordered by start time."""
+        with self._lock:
+            return sorted((dict(s) for s in self.spans), key=lambda s: s["start_ms"])
+
+
+class _NullTrace:
+    """Stand-in when tracing is off: spans are handed out and dropped."""
+
+    def tagged(self, **tags):
+        return self
+
+    def add(self, stage, t0, t1, **attrs):
+        return {}
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        yield {}
+
+    def export(self):
+        return []
+
+
+_NULL_TRACE = _NullTrace()
+
+
+def _note_model(span, raw):
+    """Copy model-reported latency and token counts from a cactus result onto a span."""
+    raw = raw or {}
+    span["model_ms"] = _get_ms(raw)
+    for key in ("prefill_tokens", "decode_tokens", "tokens_saved"):
+        if key in raw:
+            span[key] = raw[key]
 
 
 # ---------------------------------------------------------------------------
 # Generators
 # ---------------------------------------------------------------------------
 
-def generate_cactus(messages, tools, extra_nouns=None):
+# Split sub-queries decoded concurrently (bounded by the model pool size too).
+_SPLIT_PARALLELISM = 3
+
+# Tool schemas sent to FunctionGemma in attempt 1 (0 = always send all).
+_TOOL_PRESELECT_K = 5
+
+
+def generate_cactus(messages, tools, extra_nouns=None, index=None, model=None, hedge=None,
+                    budget=None, trace=None):
     """
     On-device function calling with multi-strategy fallback:
 
@@ -699,47 +2245,116 @@ def generate_cactus(messages, tools, extra_nouns=None):
        or failed entirely, retry with only the schema-selected tool.
     3. Schema-driven extraction — try target tool first; fall back to all-tools
        only when the target was unreliably identified.
+
+    Runs on `model` if given, otherwise on a context checked out of the pool.
+    With a _CloudHedge, failure signals (attempt 1 failed, no reliable target)
+    start the cloud request early, and a valid cloud answer that is already
+    in preempts attempt 2 (result flagged "preempted").
+    With a _Budget, model attempts whose observed latency no longer fits the
+    remaining time are skipped (recorded in budget.cut); schema extraction
+    always runs since it costs no model time.
+    With a Trace, each attempt is recorded as a span. "tokens_saved" counts
+    the generation budget left unused by early-stopped streaming attempts.
     """
-    model = _get_cactus_model()
-    cactus_tools = [{"type": "function", "function": t} for t in tools]
-    user_text = " ".join(m["content"] for m in messages if m["role"] == "user")
+    return _export_result(_run_cactus(messages, tools, extra_nouns, index, model, hedge, budget, trace))
+
+
+def _run_cactus(messages, tools, extra_nouns=None, index=None, model=None, hedge=None,
+                budget=None, trace=None):
+    """generate_cactus with FunctionCall results, for use inside the router."""
+    usage = {"tokens_saved": 0}
+    if model is None:
+        with get_cactus_pool().context() as pooled:
+            result = _generate_cactus(pooled, messages, tools, extra_nouns, index, hedge, budget, trace, usage)
+    else:
+        result = _generate_cactus(model, messages, tools, extra_nouns, index, hedge, budget, trace, usage)
+    result["tokens_saved"] = usage["tokens_saved"]
+    return result
 
-    # ---- Attempt 1: Standard function calling ----
-    cactus_reset(model)
-    raw1 = _cactus_attempt(
-        model,
-        [{"role": "system", "content": _SYS_PROMPT}] + messages,
-        cactus_tools,
-    )
-    total_ms = _get_ms(raw1)
 
+def _preselect_tools(query, tools, index, k=_TOOL_PRESELECT_K):
+    """
+    The k most relevant tools by lexical score, kept in their original order.
+    Returns the full list when k is off, the list is already small, or no
+    tool shares a term with the query.
+    """
+    if not k or len(tools) <= k:
+        return tools
+    scores = index.scores(_as_query(query).token_set)
+    if not scores:
+        return tools
+    keep = sorted(scores, key=lambda tid: (-scores[tid], tid))[:k]
+    return [index.tools[tid] for tid in sorted(keep)]
+
+
+def _generate_cactus(model, messages, tools, extra_nouns, index, hedge=None, budget=None,
+                     trace=None, usage=None):
+    index = index or _get_tool_index(tools)
+    budget = budget or _Budget()
+    trace = trace or _NULL_TRACE
+    usage = usage if usage is not None else {"tokens_saved": 0}
+    user_text = " ".join(m["content"] for m in messages if m["role"] == "user")
+    query = analyze_query(user_text)
+    expected_calls = max(1, len(query.intents))
+
+    # ---- Attempt 1: Standard function calling (pre-selected tools) ----
+    # Only the top-k relevant schemas go into the prompt; if that yields no
+    # valid call, widen to the full tool list once.
+    sys_msgs = [{"role": "system", "content": _SYS_PROMPT}]
+    selected = _preselect_tools(query, tools, index)
+    total_ms = 0
+    raw1 = None
     calls1 = []
-    if raw1 and raw1.get("function_calls"):
-        fc = list(raw1["function_calls"])
-        _coerce_argument_types(fc, tools)
-        calls1 = _filter_valid_calls(fc, tools)
+    while budget.allows("attempt1"):
+        cactus_tools = [{"type": "function", "function": t} for t in selected]
+        prefix_fp = index.fingerprint if selected is tools else _tools_fingerprint(selected)
+        max_tokens = _generation_budget([index.entry(t["name"]) for t in selected], expected_calls)
+        with trace.span("attempt1", tools=len(selected), max_tokens=max_tokens) as span:
+            stage_start = time.perf_counter()
+            raw1 = _run_attempt(
+                model, sys_msgs, messages, cactus_tools, prefix_fp, max_tokens,
+                budget=budget, stage="attempt1",
+            )
+            _stage_latency.observe("attempt1", (time.perf_counter() - stage_start) * 1000)
+            total_ms += _get_ms(raw1)
+            usage["tokens_saved"] += _tokens_saved(raw1)
+            _note_model(span, raw1)
+
+            if raw1 and raw1.get("function_calls"):
+                fc = list(raw1["function_calls"])
+                _coerce_argument_types(fc, tools)
+                calls1 = _filter_valid_calls(fc, tools)
+            span["outcome"] = "ok" if calls1 else "no valid call"
+        if calls1 or selected is tools:
+            break
+        _diag("attempt1 WIDEN: no valid call from %d/%d tools", len(selected), len(tools))
+        selected = tools
 
     if calls1:
-        _diag(f"attempt1 OK: {json.dumps(calls1, ensure_ascii=False)}")
+        _diag("attempt1 OK: %s", _Json(calls1))
     else:
         resp = (raw1 or {}).get("response", "")
-        _diag(f"attempt1 FAIL: response={resp!r:.120}")
+        _diag("attempt1 FAIL: response=%.120r", resp)
 
     # Schema validation: only override when model's tool has ZERO query relevance
     skip_model_calls = False
     if calls1 and len(tools) > 1:
-        qwords = set(_tokenize(user_text))
-        schema_tool = _find_best_tool(user_text, tools)
-        if schema_tool and calls1[0]["name"] != schema_tool["name"]:
-            model_t = next((t for t in tools if t["name"] == calls1[0]["name"]), None)
-            m_rel = _tool_relevance(model_t, qwords) if model_t else 0
-            s_rel = _tool_relevance(schema_tool, qwords)
-            if m_rel < 0.01 and s_rel > 0.15:
-                skip_model_calls = True
-                _diag(f"schema OVERRIDE: model={calls1[0]['name']} schema={schema_tool['name']} (m_rel={m_rel:.2f} s_rel={s_rel:.2f})")
+        with trace.span("schema_override") as span:
+            qwords = query.token_set
+            schema_tool = _find_best_tool(query, tools, index=index)
+            if schema_tool and calls1[0].name != schema_tool["name"]:
+                model_t = index.by_name.get(calls1[0].name)
+                m_rel = _tool_relevance(model_t, qwords, index.entry(model_t["name"])) if model_t else 0
+                s_rel = _tool_relevance(schema_tool, qwords, index.entry(schema_tool["name"]))
+                if m_rel < 0.01 and s_rel > 0.15:
+                    skip_model_calls = True
+            span["outcome"] = "override" if skip_model_calls else "keep"
+        if skip_model_calls:
+            _diag("schema OVERRIDE: model=%s schema=%s (m_rel=%.2f s_rel=%.2f)",
+                  calls1[0].name, schema_tool["name"], m_rel, s_rel, level=_INFO)
 
     if calls1 and not skip_model_calls:
-        calls1 = _maybe_prefer_schema(calls1, user_text, tools, extra_nouns=extra_nouns)
+        calls1 = _maybe_prefer_schema(calls1, query, tools, extra_nouns=extra_nouns, index=index)
         return {
             "function_calls": _post_process_args(calls1),
             "total_time_ms": total_ms,
@@ -747,8 +2362,11 @@ def generate_cactus(messages, tools, extra_nouns=None):
             "cloud_handoff": False,
         }
 
+    if hedge:
+        hedge.start("attempt1 failed")
+
     # ---- Find the best target tool for retry ----
-    target = _find_best_tool(user_text, tools)
+    target = _find_best_tool(query, tools, index=index)
     target_reliable = target is not None
     if not target:
         model_text = (raw1 or {}).get("response", "") or ""
@@ -756,46 +2374,70 @@ def generate_cactus(messages, tools, extra_nouns=None):
     if not target and len(tools) == 1:
         target = tools[0]
         target_reliable = True
-    _diag(f"target tool for retry: {target['name'] if target else 'NONE'} (reliable={target_reliable})")
+    _diag("target tool for retry: %s (reliable=%s)", target["name"] if target else "NONE", target_reliable)
+    if hedge and not target_reliable:
+        hedge.start("no reliable target tool")
+
+    if hedge and hedge.valid_result() is not None:
+        _diag("attempt2 SKIPPED: hedged cloud result already valid", level=_INFO)
+        return {
+            "function_calls": [],
+            "total_time_ms": total_ms,
+            "confidence": 0,
+            "cloud_handoff": True,
+            "preempted": True,
+        }
 
     # ---- Attempt 2: Single-tool retry (schema-guided) ----
-    if target:
+    if target and budget.allows("attempt2"):
         single = [{"type": "function", "function": target}]
-        cactus_reset(model)
-        raw2 = _cactus_attempt(model, messages, single, temperature=0)
-        total_ms += _get_ms(raw2)
-
-        if raw2 and raw2.get("function_calls"):
-            fc = list(raw2["function_calls"])
-            _coerce_argument_types(fc, [target])
-            calls2 = _filter_valid_calls(fc, [target])
-            if calls2:
-                calls2 = _maybe_prefer_schema(calls2, user_text, [target], extra_nouns=extra_nouns)
-                _diag(f"attempt2 OK: {json.dumps(calls2, ensure_ascii=False)}")
-                return {
-                    "function_calls": _post_process_args(calls2),
-                    "total_time_ms": total_ms,
-                    "confidence": float(raw2.get("confidence", 0) or 0),
-                    "cloud_handoff": False,
-                }
+        calls2 = []
+        max_tokens = _generation_budget([index.entry(target["name"])], expected_calls)
+        with trace.span("attempt2", tool=target["name"], max_tokens=max_tokens) as span:
+            stage_start = time.perf_counter()
+            raw2 = _run_attempt(
+                model, [], messages, single, _tools_fingerprint([target]), max_tokens,
+                budget=budget, stage="attempt2", temperature=0,
+            )
+            _stage_latency.observe("attempt2", (time.perf_counter() - stage_start) * 1000)
+            total_ms += _get_ms(raw2)
+            usage["tokens_saved"] += _tokens_saved(raw2)
+            _note_model(span, raw2)
+
+            if raw2 and raw2.get("function_calls"):
+                fc = list(raw2["function_calls"])
+                _coerce_argument_types(fc, [target])
+                calls2 = _filter_valid_calls(fc, [target])
+            span["outcome"] = "ok" if calls2 else "no valid call"
+        if calls2:
+            calls2 = _maybe_prefer_schema(calls2, query, [target], extra_nouns=extra_nouns, index=index)
+            _diag("attempt2 OK: %s", _Json(calls2))
+            return {
+                "function_calls": _post_process_args(calls2),
+                "total_time_ms": total_ms,
+                "confidence": float(raw2.get("confidence", 0) or 0),
+                "cloud_handoff": False,
+            }
 
         resp2 = (raw2 or {}).get("response", "")
-        _diag(f"attempt2 FAIL: response={resp2!r:.120}")
+        _diag("attempt2 FAIL: response=%.120r", resp2)
 
     # ---- Attempt 3: Schema-driven extraction ----
     # 3a: Try the identified target tool first
     target_call = None
     if target:
-        ext = _extract_from_schema(user_text, target, extra_nouns=extra_nouns)
-        if ext:
-            _coerce_argument_types([ext], [target])
-            valid = _filter_valid_calls([ext], [target])
-            if valid:
-                target_call = valid[0]
+        with trace.span("attempt3a", tool=target["name"]) as span:
+            ext = _extract_from_schema(query, target, extra_nouns=extra_nouns, entry=index.entry(target["name"]))
+            if ext:
+                _coerce_argument_types([ext], [target])
+                valid = _filter_valid_calls([ext], [target])
+                if valid:
+                    target_call = valid[0]
+            span["outcome"] = "ok" if target_call else "no valid call"
 
     # 3b: If target is reliable, trust it
     if target_call and target_reliable:
-        _diag(f"attempt3 (target extract) OK: {json.dumps([target_call], ensure_ascii=False)}")
+        _diag("attempt3 (target extract) OK: %s", _Json([target_call]))
         return {
             "function_calls": _post_process_args([target_call]),
             "total_time_ms": total_ms,
@@ -804,18 +2446,22 @@ def generate_cactus(messages, tools, extra_nouns=None):
         }
 
     # 3c: Target unreliable or failed — try all tools and compare
-    best_all, best_all_score = _best_extract_all_tools(user_text, tools, extra_nouns=extra_nouns)
+    with trace.span("attempt3c", tools=len(tools)) as span:
+        best_all, best_all_score = _best_extract_all_tools(query, tools, extra_nouns=extra_nouns, index=index)
+        span["outcome"] = "ok" if best_all else "no valid call"
+        if best_all:
+            span.update(tool=best_all.name, score=best_all_score)
     if target_call and best_all:
-        target_score = _arg_query_overlap([target_call], user_text, tools, extra_nouns=extra_nouns)
+        target_score = _arg_query_overlap([target_call], query, tools, extra_nouns=extra_nouns)
         if best_all_score > target_score:
-            _diag(f"attempt3 (all-tools) OK: {json.dumps([best_all], ensure_ascii=False)} score={best_all_score} > target={target_score}")
+            _diag("attempt3 (all-tools) OK: %s score=%s > target=%s", _Json([best_all]), best_all_score, target_score)
             return {
                 "function_calls": _post_process_args([best_all]),
                 "total_time_ms": total_ms,
                 "confidence": 0.5,
                 "cloud_handoff": False,
             }
-        _diag(f"attempt3 (target wins) OK: {json.dumps([target_call], ensure_ascii=False)} score={target_score}")
+        _diag("attempt3 (target wins) OK: %s score=%s", _Json([target_call]), target_score)
         return {
             "function_calls": _post_process_args([target_call]),
             "total_time_ms": total_ms,
@@ -823,7 +2469,7 @@ def generate_cactus(messages, tools, extra_nouns=None):
             "cloud_handoff": False,
         }
     if best_all and best_all_score > 0:
-        _diag(f"attempt3 (all-tools) OK: {json.dumps([best_all], ensure_ascii=False)} score={best_all_score}")
+        _diag("attempt3 (all-tools) OK: %s score=%s", _Json([best_all]), best_all_score)
         return {
             "function_calls": _post_process_args([best_all]),
             "total_time_ms": total_ms,
@@ -831,7 +2477,7 @@ def generate_cactus(messages, tools, extra_nouns=None):
             "cloud_handoff": False,
         }
     if target_call:
-        _diag(f"attempt3 (target extract) OK: {json.dumps([target_call], ensure_ascii=False)}")
+        _diag("attempt3 (target extract) OK: %s", _Json([target_call]))
         return {
             "function_calls": _post_process_args([target_call]),
             "total_time_ms": total_ms,
@@ -840,7 +2486,7 @@ def generate_cactus(messages, tools, extra_nouns=None):
         }
     _diag("attempt3 FAIL")
 
-    _diag("ALL LOCAL ATTEMPTS FAILED")
+    _diag("ALL LOCAL ATTEMPTS FAILED", level=_INFO)
     return {
         "function_calls": [],
         "total_time_ms": total_ms,
@@ -886,13 +2532,36 @@ def _json_schema_to_gemini(schema):
         return types.Schema(type=type_map.get(schema_type, types.Type.STRING), description=description)
 
 
-def generate_cloud(messages, tools):
-    """Run function calling via Gemini Cloud API."""
-    api_key = _get_gemini_api_key()
-    if not api_key:
-        raise RuntimeError("Missing GEMINI_API_KEY")
-    client = genai.Client(api_key=api_key)
-
+_GEMINI_MODEL = "gemini-3.0-flash"
+
+_gemini_client = None
+_gemini_client_lock = threading.Lock()
+_GEMINI_TOOLS_CACHE_SIZE = 32
+_gemini_tools_cache = OrderedDict()
+_gemini_tools_lock = threading.Lock()
+
+
+def _get_gemini_client():
+    """Long-lived Gemini client (reads the API key once, reuses connections)."""
+    global _gemini_client
+    if _gemini_client is None:
+        with _gemini_client_lock:
+            if _gemini_client is None:
+                api_key = _get_gemini_api_key()
+                if not api_key:
+                    raise RuntimeError("Missing GEMINI_API_KEY")
+                _gemini_client = genai.Client(api_key=api_key)
+    return _gemini_client
+
+
+def _get_gemini_tools(tools, index=None):
+    """types.Tool declarations for this tool list, memoized (LRU) by its fingerprint."""
+    fp = (index or _get_tool_index(tools)).fingerprint
+    with _gemini_tools_lock:
+        gemini_tools = _gemini_tools_cache.get(fp)
+        if gemini_tools is not None:
+            _gemini_tools_cache.move_to_end(fp)
+            return gemini_tools
     gemini_tools = [
         types.Tool(function_declarations=[
             types.FunctionDeclaration(
@@ -903,32 +2572,65 @@ def generate_cloud(messages, tools):
             for t in tools
         ])
     ]
+    with _gemini_tools_lock:
+        _gemini_tools_cache[fp] = gemini_tools
+        _gemini_tools_cache.move_to_end(fp)
+        while len(_gemini_tools_cache) > _GEMINI_TOOLS_CACHE_SIZE:
+            _gemini_tools_cache.popitem(last=False)
+    return gemini_tools
+
+
+def warm_cloud(tools=None):
+    """
+    Create the Gemini client, precompute declarations for `tools`, and make
+    one lightweight request so TLS setup is paid at startup, not on the
+    first fallback.
+    """
+    client = _get_gemini_client()
+    if tools:
+        _get_gemini_tools(tools)
+    client.models.get(model=_GEMINI_MODEL)
+
+
+def _gemini_config(gemini_tools, timeout_ms=None):
+    """GenerateContentConfig, with a per-request HTTP timeout when given."""
+    if timeout_ms is None:
+        return types.GenerateContentConfig(tools=gemini_tools)
+    return types.GenerateContentConfig(
+        tools=gemini_tools,
+        http_options=types.HttpOptions(timeout=max(1, int(timeout_ms))),
+    )
+
+
+def generate_cloud(messages, tools, index=None, timeout_ms=None):
+    """Run function calling via Gemini Cloud API (timeout_ms bounds the request)."""
+    return _export_result(_run_cloud(messages, tools, index, timeout_ms))
+
+
+def _run_cloud(messages, tools, index=None, timeout_ms=None):
+    """generate_cloud with FunctionCall results, for use inside the router."""
+    client = _get_gemini_client()
+    gemini_tools = _get_gemini_tools(tools, index)
 
     contents = [m["content"] for m in messages if m["role"] == "user"]
 
     start_time = time.time()
 
     gemini_response = client.models.generate_content(
-        model="gemini-3.0-flash",
+        model=_GEMINI_MODEL,
         contents=contents,
-        config=types.GenerateContentConfig(tools=gemini_tools),
+        config=_gemini_config(gemini_tools, timeout_ms),
     )
 
     total_time_ms = (time.time() - start_time) * 1000
 
     function_calls = []
     text_response = ""
-    if gemini_response.candidates:
-        for candidate in gemini_response.candidates:
-            if candidate.content and candidate.content.parts:
-                for part in candidate.content.parts:
-                    if part.function_call:
-                        function_calls.append({
-                            "name": part.function_call.name,
-                            "arguments": dict(part.function_call.args),
-                        })
-                    if part.text:
-                        text_response += part.text
+    for part in _gemini_parts(gemini_response):
+        if part.function_call:
+            function_calls.append(_gemini_call(part.function_call))
+        if part.text:
+            text_response += part.text
 
     return {
         "function_calls": _post_process_args(function_calls),
@@ -937,72 +2639,745 @@ def generate_cloud(messages, tools):
     }
 
 
-def generate_hybrid(messages, tools, confidence_threshold=0.7):
+def _gemini_parts(response):
+    """All content parts of a Gemini response (or stream chunk)."""
+    for candidate in response.candidates or []:
+        if candidate.content and candidate.content.parts:
+            yield from candidate.content.parts
+
+
+def _gemini_finished(chunk):
+    """True once a candidate in this stream chunk reports why the turn ended."""
+    for candidate in chunk.candidates or []:
+        reason = getattr(candidate, "finish_reason", None)
+        if reason is not None and getattr(reason, "value", reason) != "FINISH_REASON_UNSPECIFIED":
+            return True
+    return False
+
+
+def _gemini_call(function_call):
+    return FunctionCall(function_call.name, dict(function_call.args or {}))
+
+
+async def generate_cloud_async(messages, tools, index=None, on_text=None, timeout_ms=None):
+    """
+    Streaming, non-blocking variant of generate_cloud.
+
+    Text is forwarded as it streams in. Function calls are collected until
+    a chunk carries a finish reason (the turn is complete, so no further
+    call parts can follow), which returns without waiting for the stream's
+    trailing chunks. on_text, if given, receives text chunks (sync or async
+    callable); anything after the early return keeps flowing to it from a
+    background task. timeout_ms bounds the HTTP request, as in generate_cloud.
+    """
+    client = _get_gemini_client()
+    gemini_tools = _get_gemini_tools(tools, index)
+    contents = [m["content"] for m in messages if m["role"] == "user"]
+
+    async def emit(text):
+        if on_text is not None:
+            res = on_text(text)
+            if inspect.isawaitable(res):
+                await res
+
+    start_time = time.time()
+    stream = await client.aio.models.generate_content_stream(
+        model=_GEMINI_MODEL,
+        contents=contents,
+        config=_gemini_config(gemini_tools, timeout_ms),
+    )
+
+    function_calls = []
+    text_response = ""
+    early_exit = False
+    async for chunk in stream:
+        for part in _gemini_parts(chunk):
+            if part.function_call:
+                function_calls.append(_gemini_call(part.function_call))
+            if part.text:
+                text_response += part.text
+                await emit(part.text)
+        if _gemini_finished(chunk):
+            early_exit = True
+            break
+
+    total_time_ms = (time.time() - start_time) * 1000
+
+    if early_exit:
+        _diag("cloud stream early exit after %d call(s)", len(function_calls), level=_INFO)
+        if on_text is not None:
+            task = asyncio.ensure_future(_drain_text(stream, emit))
+            # The loop only holds a weak reference; keep the task alive until done.
+            _drain_tasks.add(task)
+            task.add_done_callback(_drain_tasks.discard)
+        elif hasattr(stream, "aclose"):
+            await stream.aclose()
+
+    return _export_result({
+        "function_calls": _post_process_args(function_calls),
+        "response": text_response,
+        "total_time_ms": total_time_ms,
+        "stream_early_exit": early_exit,
+    })
+
+
+_drain_tasks = set()
+
+
+async def _drain_text(stream, emit):
+    """Forward the remaining text of a Gemini stream after an early return."""
+    try:
+        async for chunk in stream:
+            for part in _gemini_parts(chunk):
+                if part.text:
+                    await emit(part.text)
+    except Exception as e:
+        _diag("cloud stream drain FAIL: %s", e, level=_WARNING)
+
+
+# ---------------------------------------------------------------------------
+# Hedged cloud requests — start Gemini early when local is likely to fail
+# ---------------------------------------------------------------------------
+
+# Relevance gap (top tool vs runner-up) below which the cloud call is hedged
+# before the local model even runs.
+_HEDGE_MARGIN = 0.1
+
+_cloud_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cloud-hedge")
+
+
+class _CloudHedge:
+    """A generate_cloud call started speculatively in the background."""
+
+    def __init__(self, messages, tools, index=None):
+        self.messages = messages
+        self.tools = tools
+        self.index = index
+        self.future = None
+        self.reason = None
+        self.started_at = None
+        self.done_at = None
+
+    @property
+    def started(self):
+        return self.future is not None
+
+    def start(self, reason):
+        """Fire the cloud request (no-op if already in flight)."""
+        if self.future is not None:
+            return
+        self.reason = reason
+        self.started_at = time.perf_counter()
+        _diag("hedge START: %s", reason, level=_INFO)
+        self.future = _cloud_executor.submit(_run_cloud, self.messages, self.tools, self.index)
+        self.future.add_done_callback(self._mark_done)
+
+    def _mark_done(self, _future):
+        self.done_at = time.perf_counter()
+
+    def valid_result(self, before=None):
+        """The cloud result if it has arrived (before `before`) with valid calls."""
+        if self.future is None or not self.future.done() or self.future.exception():
+            return None
+        if before is not None and (self.done_at is None or self.done_at > before):
+            return None
+        result = self.future.result()
+        return result if _filter_valid_calls(result.get("function_calls") or [], self.tools) else None
+
+    def result(self, timeout=None):
+        """Block for the cloud result (re-raising its error, like generate_cloud)."""
+        return self.future.result(timeout=timeout)
+
+    def report(self, winner):
+        """Summary for the result dict; cancels the cloud call if local won."""
+        wasted_ms = 0.0
+        if self.future is not None and winner == "local":
+            if not self.future.cancel():
+                end = self.done_at or time.perf_counter()
+                wasted_ms = (end - self.started_at) * 1000
+        return {
+            "started": self.started,
+            "reason": self.reason,
+            "winner": winner,
+            "cloud_wasted_ms": wasted_ms,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Routing predictor — learned probability that the local pipeline succeeds
+# ---------------------------------------------------------------------------
+
+_ROUTE_PREDICTOR_PATH = os.environ.get("ROUTE_PREDICTOR_PATH") or os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), ".route_predictor.json"
+)
+# Below this predicted success probability local attempts are skipped...
+_ROUTE_SKIP_BELOW = 0.15
+# ...but only once the model has seen enough outcomes,
+_ROUTE_MIN_UPDATES = 50
+# and a small fraction of skips still run locally so the model keeps learning.
+_ROUTE_EXPLORE = 0.05
+
+_ROUTE_FEATURES = (
+    "bias", "top_score", "margin", "parts", "proper_nouns", "query_words",
+    "tool_count", "tool_success_rate",
+)
+
+
+class RoutePredictor:
+    """
+    Online logistic regression over cheap query features, predicting whether
+    generate_cactus will produce a valid call. One SGD step per observed
+    outcome; weights and per-tool success rates persist to `path` as JSON.
+    """
+
+    def __init__(self, path=_ROUTE_PREDICTOR_PATH, lr=0.05, l2=1e-4, save_every=20):
+        self.path = path
+        self.lr = lr
+        self.l2 = l2
+        self.save_every = save_every
+        self.weights = [0.0] * len(_ROUTE_FEATURES)
+        self.tool_rates = {}
+        self.updates = 0
+        self.skips = 0
+        self._dirty = 0
+        self._save_pending = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if data.get("features") != list(_ROUTE_FEATURES):
+            _diag("route predictor: feature set changed, starting fresh", level=_WARNING)
+            return
+        self.weights = [float(w) for w in data["weights"]]
+        self.tool_rates = {k: float(v) for k, v in data.get("tool_rates", {}).items()}
+        self.updates = int(data.get("updates", 0))
+
+    def save(self):
+        with self._lock:
+            self._save_pending = False
+            data = {
+                "features": list(_ROUTE_FEATURES),
+                "weights": list(self.weights),
+                "tool_rates": dict(self.tool_rates),
+                "updates": self.updates,
+            }
+            self._dirty = 0
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            _diag("route predictor save FAIL: %s", e, level=_WARNING)
+
+    def features(self, query, tools, index):
+        """Feature vector (ordered as _ROUTE_FEATURES) plus the top tool's name."""
+        query = _as_query(query)
+        ranked = index.top_k(query.token_set, 2)
+        top = ranked[0][1] if ranked else 0.0
+        margin = top - (ranked[1][1] if len(ranked) > 1 else 0.0) if ranked else 0.0
+        top_name = ranked[0][0]["name"] if ranked else None
+        with self._lock:
+            rate = self.tool_rates.get(top_name, 0.5)
+        x = [
+            1.0,
+            top,
+            margin,
+            min(len(query.intents), 4) / 4,
+            min(len(query.proper_nouns), 4) / 4,
+            min(len(query.words), 40) / 40,
+            min(len(tools), 50) / 50,
+            rate,
+        ]
+        return x, top_name
+
+    def predict(self, x):
+        with self._lock:
+            z = sum(w * v for w, v in zip(self.weights, x))
+        return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+    @property
+    def trained(self):
+        return self.updates >= _ROUTE_MIN_UPDATES
+
+    def update(self, x, top_name, success):
+        """One SGD step on the observed outcome; saves (in the background) every save_every updates."""
+        y = 1.0 if success else 0.0
+        err = y - self.predict(x)
+        with self._lock:
+            self.weights = [w + self.lr * (err * v - self.l2 * w) for w, v in zip(self.weights, x)]
+            if top_name is not None:
+                prev = self.tool_rates.get(top_name, 0.5)
+                self.tool_rates[top_name] = 0.9 * prev + 0.1 * y
+            self.updates += 1
+            self._dirty += 1
+            due = self._dirty >= self.save_every and not self._save_pending
+            if due:
+                self._save_pending = True
+        if due:
+            # File I/O stays off the request thread; one writer serializes saves.
+            _route_save_executor.submit(self.save)
+
+    def note_skip(self):
+        with self._lock:
+            self.skips += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "path": self.path,
+                "updates": self.updates,
+                "trained": self.updates >= _ROUTE_MIN_UPDATES,
+                "skips": self.skips,
+                "weights": dict(zip(_ROUTE_FEATURES, self.weights)),
+            }
+
+
+_route_predictor = None
+_route_predictor_lock = threading.Lock()
+_route_save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="route-save")
+
+
+def get_route_predictor():
+    """Process-wide RoutePredictor, loaded from disk on first use and saved at exit."""
+    global _route_predictor
+    if _route_predictor is None:
+        with _route_predictor_lock:
+            if _route_predictor is None:
+                _route_predictor = RoutePredictor()
+                atexit.register(_route_predictor.save)
+    return _route_predictor
+
+
+def route_predictor_stats():
+    return get_route_predictor().stats()
+
+
+def generate_hybrid(messages, tools, confidence_threshold=0.7,
+                    rule_first=False, rule_margin=_RULE_FIRST_MARGIN, use_cache=True,
+                    parallelism=_SPLIT_PARALLELISM, hedge=False, cloud_fallback=True,
+                    deadline_ms=None, predict_route=False, trace=None, semantic_cache=False):
     """
     Smart heuristic router for edge-cloud inference.
 
     Pipeline:
+        0. (rule_first only) Single-intent queries whose schema extraction is
+           unambiguous (see _rule_first_call) return immediately with
+           source "on-device (rules)", skipping the model entirely.
         1. Run local model with multi-strategy fallback (generate_cactus).
         2. If the query has multiple intents (conjunctions) and the model
            returned fewer calls than expected, split and run each part
-           through the full local pipeline, then MERGE results.
+           through the full local pipeline (up to `parallelism` parts
+           concurrently, merged in query order), then MERGE results.
            Proper nouns from the full query are forwarded to split parts
            for pronoun resolution (e.g. "him" → "Tom").
         3. Cloud fallback only when all local attempts produce nothing.
+           With hedge, the cloud request starts early in the background
+           when local failure looks likely (low relevance margin, attempt 1
+           failed, no reliable target); the first valid result wins and
+           "hedge" records the winner and the wasted cloud time.
+           With cloud_fallback=False the call is skipped and the result is
+           returned with "cloud_handoff": True, so async callers can await
+           generate_cloud_async themselves.
+
+    With deadline_ms, every stage is checked against the remaining budget
+    using the observed latency of that stage: model attempts and the split
+    phase are skipped when they no longer fit, and the cloud call is given
+    the remaining time as its timeout (or skipped below
+    _CLOUD_MIN_BUDGET_MS, with source "none (deadline)"). "budget" in the
+    result lists the stages that were cut.
+
+    With predict_route, a RoutePredictor estimates the probability that the
+    local pipeline succeeds (reported as "route"); once trained, queries
+    below _ROUTE_SKIP_BELOW go straight to the cloud. Every query that does
+    run locally updates the predictor with its outcome.
+
+    With trace (a Trace, or True for a fresh one), every stage — cache
+    lookups, rules, each cactus attempt, split parts, cloud — is recorded
+    as a span and the list is returned as "trace".
+
+    With use_cache, repeated queries (same normalized text and tool set) are
+    answered from the result cache with source "on-device (cache)". With
+    semantic_cache as well (and query embeddings available), paraphrases of a
+    cached single-call query reuse its tool (arguments re-extracted from the
+    schema) with source "on-device (semantic cache)". It is opt-in because
+    the embedding costs a model pass on every cache miss; multi-intent
+    queries never use it, since only single-call results are stored.
     """
+    if trace is True:
+        trace = Trace()
+    result = _export_result(_generate_hybrid(
+        messages, tools, rule_first=rule_first, rule_margin=rule_margin,
+        use_cache=use_cache, parallelism=parallelism, hedge=hedge,
+        cloud_fallback=cloud_fallback, deadline_ms=deadline_ms,
+        predict_route=predict_route, trace=trace or _NULL_TRACE,
+        semantic_cache=semantic_cache,
+    ))
+    if trace:
+        result["trace"] = trace.export()
+    return result
+
+
+def _generate_hybrid(messages, tools, rule_first, rule_margin, use_cache, parallelism,
+                     hedge, cloud_fallback, deadline_ms, predict_route, trace, semantic_cache=False):
+    budget = _Budget(deadline_ms)
     user_text = " ".join(m["content"] for m in messages if m["role"] == "user")
-    local = generate_cactus(messages, tools)
+    index = _get_tool_index(tools)
+
+    def route():
+        return _route_hybrid(
+            messages, tools, user_text, index, rule_first=rule_first,
+            rule_margin=rule_margin, parallelism=parallelism, hedge=hedge,
+            cloud_fallback=cloud_fallback, budget=budget, predict_route=predict_route,
+            trace=trace,
+        )
 
-    model_calls = _filter_valid_calls(local["function_calls"], tools)
-    model_calls = _deduplicate_calls(model_calls)
+    if not use_cache:
+        return route()
+
+    key = _result_cache_key(user_text, index)
+    with trace.span("cache") as span:
+        cached = _result_cache.get(key, tools)
+        span["outcome"] = "hit" if cached is not None else "miss"
+    if cached is not None:
+        _diag("cache HIT: %s", cached["cached_source"], level=_INFO)
+        return cached
+
+    vec = None
+    query = analyze_query(user_text)
+    if semantic_cache and _semantic_cache.enabled and len(query.intents) <= 1:
+        with trace.span("semantic_cache") as span:
+            vec = _embed_query(user_text)
+            near = _semantic_cache_call(query, vec, index)
+            span["outcome"] = "hit" if near else "miss"
+        if near:
+            _result_cache.put(key, near, tools)
+            return near
+
+    result = route()
+    if not budget.cut:
+        # A deadline-degraded answer is not what an unhurried run would give.
+        _store_result(key, vec, index, result, tools)
+    return result
 
-    parts = re.split(r'\s+and\s+|,\s*and\s+|,\s+', user_text)
-    parts = [p.strip() for p in parts if len(p.strip()) > 5]
-    expected_count = max(1, len(parts))
 
-    total_ms = local["total_time_ms"]
+def _store_result(key, vec, index, result, tools):
+    _result_cache.put(key, result, tools)
+    calls = _filter_valid_calls(result.get("function_calls") or [], tools)
+    if vec is not None and len(calls) == 1:
+        _semantic_cache.add(vec, index.fingerprint, calls[0].name, result.get("source"))
 
-    if len(parts) > 1 and len(model_calls) < expected_count:
-        full_nouns = _extract_proper_nouns(user_text)
-        _diag(f"SPLIT: {len(parts)} parts, model has {len(model_calls)}/{expected_count} calls, context_nouns={full_nouns}")
-        split_calls = []
-        for part in parts:
-            _diag(f"  split part: {part!r}")
-            sub = generate_cactus(
+
+def cache_result(messages, tools, result, semantic_cache=False):
+    """
+    Store a result produced outside generate_hybrid — e.g. the cloud answer
+    awaited after a cloud_fallback=False handoff — so repeats of the query
+    hit the result cache (and, with semantic_cache, its paraphrases too).
+    """
+    user_text = " ".join(m["content"] for m in messages if m["role"] == "user")
+    index = _get_tool_index(tools)
+    vec = None
+    if semantic_cache and _semantic_cache.enabled and len(analyze_query(user_text).intents) <= 1:
+        vec = _embed_query(user_text)
+    _store_result(_result_cache_key(user_text, index), vec, index, result, tools)
+
+
+def _run_split_parts(parts, tools, full_nouns, index, parallelism, budget=None, trace=_NULL_TRACE):
+    """
+    Run each split part through generate_cactus, up to `parallelism` at once,
+    each on its own pooled model context. Returns (results, timings, wall_ms)
+    with results and timings in part order regardless of completion order.
+    """
+    def run_part(part):
+        part_trace = trace.tagged(part=part)
+        with part_trace.span("split_part") as span:
+            start = time.perf_counter()
+            sub = _run_cactus(
                 [{"role": "user", "content": part}], tools,
-                extra_nouns=full_nouns,
+                extra_nouns=full_nouns, index=index, budget=budget, trace=part_trace,
             )
-            sub_calls = _filter_valid_calls(sub["function_calls"], tools)
-            split_calls.extend(sub_calls)
-            total_ms += sub["total_time_ms"]
+            wall_ms = (time.perf_counter() - start) * 1000
+            span["model_ms"] = sub["total_time_ms"]
+            span["outcome"] = "ok" if sub["function_calls"] else "no valid call"
+        _stage_latency.observe("split_part", wall_ms)
+        return sub, {"part": part, "wall_ms": wall_ms, "model_ms": sub["total_time_ms"]}
+
+    start = time.perf_counter()
+    if parallelism > 1:
+        with ThreadPoolExecutor(max_workers=min(parallelism, len(parts))) as pool:
+            outcomes = list(pool.map(run_part, parts))
+    else:
+        outcomes = [run_part(part) for part in parts]
+    wall_ms = (time.perf_counter() - start) * 1000
+    return [o[0] for o in outcomes], [o[1] for o in outcomes], wall_ms
+
+
+def _route_hybrid(messages, tools, user_text, index, rule_first=False,
+                  rule_margin=_RULE_FIRST_MARGIN, parallelism=_SPLIT_PARALLELISM,
+                  hedge=False, cloud_fallback=True, budget=None, predict_route=False,
+                  trace=_NULL_TRACE):
+    """Uncached generate_hybrid pipeline."""
+    budget = budget or _Budget()
+    start = time.perf_counter()
+    query = analyze_query(user_text)
+    parts = list(query.intents)
+    expected_count = max(1, len(parts))
+
+    if rule_first and len(parts) <= 1:
+        with trace.span("rule_first") as span:
+            fast = _rule_first_call(query, tools, index, margin=rule_margin)
+            span["outcome"] = "ok" if fast else "ambiguous"
+        if fast:
+            return fast
+
+    predictor = route = None
+    skip_local = False
+    if predict_route:
+        predictor = get_route_predictor()
+        features, top_name = predictor.features(query, tools, index)
+        p_local = predictor.predict(features)
+        skip_local = (predictor.trained and p_local < _ROUTE_SKIP_BELOW
+                      and random.random() >= _ROUTE_EXPLORE)
+        route = {"p_local": p_local, "skipped_local": skip_local}
+        if skip_local:
+            predictor.note_skip()
+            _diag("route SKIP local: p_local=%.2f", p_local, level=_INFO)
+
+    cloud_hedge = None
+    if hedge:
+        cloud_hedge = _CloudHedge(messages, tools, index)
+        ranked = index.top_k(query.token_set, 2)
+        gap = ranked[0][1] - (ranked[1][1] if len(ranked) > 1 else 0.0) if ranked else 0.0
+        if gap < _HEDGE_MARGIN:
+            cloud_hedge.start(f"low relevance margin ({gap:.2f})")
+
+    if skip_local:
+        local = {"function_calls": [], "total_time_ms": 0, "confidence": 0, "cloud_handoff": True}
+        if cloud_hedge:
+            cloud_hedge.start("predicted local failure")
+    else:
+        local = _run_cactus(messages, tools, index=index, hedge=cloud_hedge, budget=budget,
+                            trace=trace)
+
+    model_calls = _filter_valid_calls(local["function_calls"], tools)
+    model_calls = _deduplicate_calls(model_calls)
+
+    total_ms = local["total_time_ms"]
+    tokens_saved = local.get("tokens_saved", 0)
+    split_timings = None
+
+    hedge_won = cloud_hedge is not None and cloud_hedge.valid_result() is not None
+    split_waves = -(-len(parts) // max(1, parallelism))
+    split_cost = _stage_latency.estimate("split_part") * split_waves
+    if (len(parts) > 1 and len(model_calls) < expected_count and not hedge_won
+            and not skip_local and budget.allows("split", split_cost)):
+        full_nouns = _extract_proper_nouns(query)
+        _diag("SPLIT: %d parts, model has %d/%d calls, context_nouns=%s",
+              len(parts), len(model_calls), expected_count, full_nouns, level=_INFO)
+        subs, split_timings, split_wall_ms = _run_split_parts(
+            parts, tools, full_nouns, index, parallelism, budget=budget, trace=trace,
+        )
+        split_calls = []
+        for sub in subs:
+            split_calls.extend(_filter_valid_calls(sub["function_calls"], tools))
+            tokens_saved += sub.get("tokens_saved", 0)
+        # Parts overlap in time, so count the phase's wall clock, not the sum.
+        total_ms += split_wall_ms
         split_calls = _deduplicate_calls(split_calls)
 
         merged = list(split_calls)
-        existing_tools = {c["name"] for c in merged}
+        existing_tools = {c.name for c in merged}
         for mc in model_calls:
-            if mc["name"] not in existing_tools:
+            if mc.name not in existing_tools:
                 merged.append(mc)
-                existing_tools.add(mc["name"])
+                existing_tools.add(mc.name)
         merged = _deduplicate_calls(merged)
 
-        _diag(f"SPLIT result (merged): {json.dumps(merged, ensure_ascii=False)}")
+        _diag("SPLIT result (merged): %s", _Json(merged))
         if len(merged) > len(model_calls):
             model_calls = merged
 
-    if model_calls:
-        return {
+    if predictor and not skip_local and not local.get("preempted") and not budget.cut:
+        predictor.update(features, top_name, bool(model_calls))
+
+    local_done = time.perf_counter()
+    cloud_first = cloud_hedge.valid_result(before=local_done) if cloud_hedge else None
+    if cloud_first is not None:
+        # The hedged cloud call returned valid calls before local finished.
+        result = dict(cloud_first)
+        result["source"] = "cloud (hedged)"
+        result["local_confidence"] = local.get("confidence", 0)
+        result["total_time_ms"] = (cloud_hedge.done_at - start) * 1000
+        result["hedge"] = cloud_hedge.report("cloud")
+    elif model_calls:
+        result = {
             "function_calls": model_calls,
             "total_time_ms": total_ms,
             "confidence": local.get("confidence", 0),
             "source": "on-device",
         }
+        if cloud_hedge:
+            result["hedge"] = cloud_hedge.report("local")
+    elif cloud_hedge and cloud_hedge.started:
+        # Local came up empty; the cloud request is already in flight.
+        try:
+            timeout = max(0.0, budget.remaining_ms()) / 1000 if budget.limited else None
+            result = dict(cloud_hedge.result(timeout=timeout))
+            result["source"] = "cloud (hedged)"
+        except CLOUD_TIMEOUT_ERRORS as e:
+            if not budget.limited:
+                raise
+            budget.cut.append("cloud")
+            _diag("budget CUT cloud: hedged request did not finish in time (%s)", type(e).__name__, level=_INFO)
+            result = {"function_calls": [], "source": "none (deadline)"}
+        result["local_confidence"] = local.get("confidence", 0)
+        result["total_time_ms"] = (time.perf_counter() - start) * 1000
+        result["hedge"] = cloud_hedge.report("cloud")
+    elif budget.limited and budget.remaining_ms() < _CLOUD_MIN_BUDGET_MS:
+        # Not even a shortened cloud call fits; return the empty local result.
+        budget.cut.append("cloud")
+        _diag("budget CUT cloud: remaining %.0fms", budget.remaining_ms(), level=_INFO)
+        result = {
+            "function_calls": [],
+            "total_time_ms": total_ms,
+            "confidence": local.get("confidence", 0),
+            "source": "none (deadline)",
+        }
+    elif not cloud_fallback:
+        result = {
+            "function_calls": [],
+            "total_time_ms": total_ms,
+            "confidence": local.get("confidence", 0),
+            "cloud_handoff": True,
+        }
+    else:
+        # --- Cloud fallback (shortened to the remaining budget) ---
+        timeout_ms = budget.remaining_ms() if budget.limited else None
+        cloud_start = time.perf_counter()
+        with trace.span("cloud") as span:
+            try:
+                result = _run_cloud(messages, tools, index=index, timeout_ms=timeout_ms)
+                result["source"] = "cloud (fallback)"
+                _stage_latency.observe("cloud", (time.perf_counter() - cloud_start) * 1000)
+                span["outcome"] = "ok" if result["function_calls"] else "no call"
+            except CLOUD_TIMEOUT_ERRORS as e:
+                if not budget.limited:
+                    raise
+                budget.cut.append("cloud")
+                _diag("budget CUT cloud: request timed out within %.0fms (%s)", timeout_ms, type(e).__name__, level=_INFO)
+                result = {"function_calls": [], "total_time_ms": 0.0, "source": "none (deadline)"}
+                span["outcome"] = f"error: {type(e).__name__}"
+        result["local_confidence"] = local.get("confidence", 0)
+        result["total_time_ms"] += total_ms
+        if cloud_hedge:
+            result["hedge"] = cloud_hedge.report("cloud")
+    if cloud_hedge and cloud_hedge.started:
+        trace.add(
+            "cloud_hedge", cloud_hedge.started_at, cloud_hedge.done_at or time.perf_counter(),
+            reason=cloud_hedge.reason, outcome=f"winner: {result['hedge']['winner']}",
+        )
+    if split_timings is not None:
+        result["split_timings"] = split_timings
+    result["tokens_saved"] = tokens_saved
+    if budget.limited:
+        result["budget"] = budget.report()
+    if route is not None:
+        result["route"] = route
+    return result
 
-    # --- Cloud fallback ---
-    cloud = generate_cloud(messages, tools)
-    cloud["source"] = "cloud (fallback)"
-    cloud["local_confidence"] = local.get("confidence", 0)
-    cloud["total_time_ms"] += total_ms
-    return cloud
+
+# ---------------------------------------------------------------------------
+# Batch inference — many (messages, tools) pairs across the model pool
+# ---------------------------------------------------------------------------
+
+class HybridBatch:
+    """
+    Iterable of generate_hybrid results for a batch of (messages, tools)
+    pairs, yielded in input order as they complete. Queries are scheduled
+    grouped by tool-set fingerprint so consecutive runs on a pooled context
+    can reuse its prefilled tool prefix — only on engine builds that expose
+    the KV snapshot APIs (see _PrefixCache); otherwise grouping has no
+    effect. stats() reports throughput.
+
+    Result caches are off by default (use_cache=False) so replays of logged
+    queries measure the router, not the cache.
+    """
+
+    def __init__(self, requests, workers=None, **hybrid_kwargs):
+        self.requests = list(requests)
+        self.workers = workers or get_cactus_pool().size
+        # The pool is the bottleneck; nested split threads would only queue on it.
+        hybrid_kwargs.setdefault("parallelism", 1)
+        hybrid_kwargs.setdefault("use_cache", False)
+        self.hybrid_kwargs = hybrid_kwargs
+        self.groups = 0
+        self.errors = 0
+        self.completed = 0
+        self._start = None
+        self._end = None
+
+    def _run_one(self, i):
+        messages, tools = self.requests[i]
+        try:
+            result = generate_hybrid(messages, tools, **self.hybrid_kwargs)
+        except Exception as e:
+            _diag("batch item %d FAIL: %s", i, e, level=_WARNING)
+            result = {"function_calls": [], "total_time_ms": 0.0, "source": "error", "error": str(e)}
+        result["batch_index"] = i
+        return result
+
+    def __iter__(self):
+        order = OrderedDict()
+        for i, (_, tools) in enumerate(self.requests):
+            order.setdefault(_get_tool_index(tools).fingerprint, []).append(i)
+        self.groups = len(order)
+        self._start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hybrid-batch") as pool:
+            futures = {}
+            for indices in order.values():
+                for i in indices:
+                    futures[i] = pool.submit(self._run_one, i)
+            try:
+                for i in range(len(self.requests)):
+                    result = futures.pop(i).result()
+                    self.completed += 1
+                    if result["source"] == "error":
+                        self.errors += 1
+                    yield result
+            finally:
+                # Abandoned mid-iteration: don't run the rest of the batch.
+                for future in futures.values():
+                    future.cancel()
+        self._end = time.perf_counter()
+
+    def stats(self):
+        end = self._end or time.perf_counter()
+        wall_s = end - self._start if self._start else 0.0
+        return {
+            "queries": len(self.requests),
+            "completed": self.completed,
+            "errors": self.errors,
+            "groups": self.groups,
+            "workers": self.workers,
+            "wall_s": wall_s,
+            "qps": self.completed / wall_s if wall_s > 0 else 0.0,
+        }
+
+
+def generate_hybrid_batch(requests, workers=None, **hybrid_kwargs):
+    """
+    Run generate_hybrid over many (messages, tools) pairs on up to `workers`
+    pooled contexts (default: the pool size). Returns a HybridBatch: iterate
+    it for results in input order (each tagged "batch_index"; a failing
+    query yields source "error" instead of aborting the batch), then call
+    stats() for queries per second.
+    """
+    return HybridBatch(requests, workers=workers, **hybrid_kwargs)
 
 
 def print_result(label, result):
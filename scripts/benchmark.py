@@ -6,7 +6,7 @@ sys.path.insert(0, "cactus/python/src")
 os.environ["CACTUS_NO_CLOUD_TELE"] = "1"
 
 import json
-from src.main import generate_hybrid
+from src.main import generate_hybrid, generate_hybrid_batch
 
 
 ############## Tool definitions ##############
@@ -397,16 +397,19 @@ def compute_f1(predicted_calls, expected_calls):
     return 2 * precision * recall / (precision + recall)
 
 
-def run_benchmark(benchmarks=None):
-    """Run all benchmark cases and print results."""
+def run_benchmark(benchmarks=None, batch=False):
+    """Run all benchmark cases and print results (with batch, via generate_hybrid_batch)."""
     if benchmarks is None:
         benchmarks = BENCHMARKS
 
     total = len(benchmarks)
     results = []
+    if batch:
+        runs = generate_hybrid_batch([(case["messages"], case["tools"]) for case in benchmarks], use_cache=False)
+        outputs = iter(runs)
     for i, case in enumerate(benchmarks, 1):
         print(f"[{i}/{total}] Running: {case['name']} ({case['difficulty']})...", end=" ", flush=True)
-        result = generate_hybrid(case["messages"], case["tools"])
+        result = next(outputs) if batch else generate_hybrid(case["messages"], case["tools"])
         f1 = compute_f1(result["function_calls"], case["expected_calls"])
         source = result.get("source", "unknown")
         print(f"F1={f1:.2f} | {result['total_time_ms']:.0f}ms | {source}")
@@ -433,17 +436,20 @@ def run_benchmark(benchmarks=None):
             continue
         avg_f1 = sum(r["f1"] for r in group) / len(group)
         avg_time = sum(r["total_time_ms"] for r in group) / len(group)
-        on_device = sum(1 for r in group if r["source"] == "on-device")
+        on_device = sum(1 for r in group if r["source"].startswith("on-device"))
         cloud = len(group) - on_device
         print(f"  {difficulty:<8} avg F1={avg_f1:.2f}  avg time={avg_time:.2f}ms  on-device={on_device}/{len(group)} cloud={cloud}/{len(group)}")
 
     avg_f1 = sum(r["f1"] for r in results) / len(results)
     avg_time = sum(r["total_time_ms"] for r in results) / len(results)
     total_time = sum(r["total_time_ms"] for r in results)
-    on_device_total = sum(1 for r in results if r["source"] == "on-device")
+    on_device_total = sum(1 for r in results if r["source"].startswith("on-device"))
     cloud_total = len(results) - on_device_total
     print(f"  {'overall':<8} avg F1={avg_f1:.2f}  avg time={avg_time:.2f}ms  total time={total_time:.2f}ms")
     print(f"           on-device={on_device_total}/{len(results)} ({100*on_device_total/len(results):.0f}%)  cloud={cloud_total}/{len(results)} ({100*cloud_total/len(results):.0f}%)")
+    if batch:
+        stats = runs.stats()
+        print(f"  {'batch':<8} {stats['qps']:.1f} queries/s over {stats['wall_s']:.2f}s  ({stats['groups']} tool sets, {stats['workers']} workers)")
 
     # Total score
     score = compute_total_score(results)
@@ -479,7 +485,7 @@ def compute_total_score(results):
 
         avg_f1 = sum(r["f1"] for r in group) / len(group)
         avg_time = sum(r["total_time_ms"] for r in group) / len(group)
-        on_device_ratio = sum(1 for r in group if r["source"] == "on-device") / len(group)
+        on_device_ratio = sum(1 for r in group if r["source"].startswith("on-device")) / len(group)
 
         time_score = max(0, 1 - avg_time / time_baseline_ms)
 
@@ -490,4 +496,4 @@ def compute_total_score(results):
 
 
 if __name__ == "__main__":
-    run_benchmark()
+    run_benchmark(batch="--batch" in sys.argv)
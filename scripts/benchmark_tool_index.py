@@ -0,0 +1,103 @@
+
+import sys, os
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, "cactus/python/src")
+os.environ["CACTUS_NO_CLOUD_TELE"] = "1"
+
+import random, time
+from src.main import ToolIndex, _ToolMatrix, _tokenize, _tool_relevance
+
+
+############## Synthetic tool sets ##############
+
+VERBS = ["get", "set", "create", "delete", "list", "update", "search", "send", "play", "archive",
+         "share", "fetch", "schedule", "cancel", "upload", "download", "invite", "sync", "export", "rename"]
+NOUNS = ["weather", "alarm", "timer", "message", "reminder", "contact", "music", "page", "block",
+         "channel", "file", "event", "calendar", "task", "note", "photo", "invoice", "ticket",
+         "playlist", "document", "folder", "issue", "meeting", "comment", "project", "user"]
+FILLER = ["current", "given", "specific", "workspace", "account", "title", "content", "location",
+          "duration", "minutes", "person", "recipient", "query", "identifier", "description"]
+
+
+def make_tools(n, seed=0):
+    """Build n distinct tools with schema-shaped names, descriptions and params."""
+    rng = random.Random(seed)
+    tools = []
+    for i in range(n):
+        verb, noun = rng.choice(VERBS), rng.choice(NOUNS)
+        props = {}
+        for j in range(rng.randint(1, 3)):
+            pname = f"{rng.choice(FILLER)}_{j}"
+            props[pname] = {
+                "type": rng.choice(["string", "integer"]),
+                "description": " ".join(rng.sample(FILLER + NOUNS, 3)),
+            }
+        tools.append({
+            "name": f"{verb}_{noun}_{i}",
+            "description": f"{verb.capitalize()} a {noun} " + " ".join(rng.sample(FILLER + NOUNS, 4)),
+            "parameters": {"type": "object", "properties": props, "required": list(props)[:1]},
+        })
+    return tools
+
+
+def make_queries(n, seed=1):
+    rng = random.Random(seed)
+    return [
+        f"{rng.choice(VERBS)} the {rng.choice(NOUNS)} for {rng.choice(FILLER)} {rng.choice(NOUNS)}s"
+        for _ in range(n)
+    ]
+
+
+############## Linear baseline ##############
+
+def linear_top_k(index, query_words, k):
+    """Score every tool with _tool_relevance, as _find_best_tool used to."""
+    scored = []
+    for tid, tool in enumerate(index.tools):
+        score = _tool_relevance(tool, query_words, index.entry_list[tid])
+        if score > 0:
+            scored.append((tid, score))
+    scored.sort(key=lambda kv: (-kv[1], kv[0]))
+    return [(index.tools[tid], score) for tid, score in scored[:k]]
+
+
+def timed(fn, queries):
+    start = time.perf_counter()
+    out = [fn(q) for q in queries]
+    return out, (time.perf_counter() - start) * 1e6 / len(queries)
+
+
+def ranking(results):
+    return [[(t["name"], s) for t, s in r] for r in results]
+
+
+def run(sizes=(10, 100, 1000, 5000), n_queries=200, k=5):
+    queries = [set(_tokenize(q)) for q in make_queries(n_queries)]
+
+    print(f"  {'Tools':>6} | {'Build (ms)':>10} | {'Linear (us/q)':>13} | {'Index (us/q)':>12} | "
+          f"{'Matrix (us/q)':>13} | {'Speedup':>7} | Top-{k} match")
+    print(f"  {'-'*6}-+-{'-'*10}-+-{'-'*13}-+-{'-'*12}-+-{'-'*13}-+-{'-'*7}-+-{'-'*11}")
+    for n in sizes:
+        tools = make_tools(n)
+
+        start = time.perf_counter()
+        index = ToolIndex(tools)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        linear, linear_us = timed(lambda q: linear_top_k(index, q, k), queries)
+
+        # Same index, scored through the postings dict and then the sparse matrix.
+        index.matrix = None
+        indexed, index_us = timed(lambda q: index.top_k(q, k), queries)
+        index.matrix = _ToolMatrix(index.entry_list)
+        matrix, matrix_us = timed(lambda q: index.top_k(q, k), queries)
+
+        same = ranking(linear) == ranking(indexed) == ranking(matrix)
+        best_us = min(index_us, matrix_us)
+        print(f"  {n:>6} | {build_ms:>10.2f} | {linear_us:>13.1f} | {index_us:>12.1f} | "
+              f"{matrix_us:>13.1f} | {linear_us / best_us:>6.1f}x | {'yes' if same else 'NO'}")
+
+
+if __name__ == "__main__":
+    run()
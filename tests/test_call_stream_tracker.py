@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from src.main import _CallStreamTracker
+
+
+def feed_all(tokens):
+    tracker = _CallStreamTracker()
+    stopped_at = None
+    for i, token in enumerate(tokens):
+        if tracker.feed(token) and stopped_at is None:
+            stopped_at = i
+    return tracker, stopped_at
+
+
+def call(name, value):
+    return ["<start_function_call>", f"call:{name}{{song:", "<escape>", value, "<escape>", "}", "<end_function_call>"]
+
+
+def test_not_done_after_first_call_of_several():
+    tokens = call("play_music", "jazz") + call("play_music", "rock") + ["<end_of_turn>"]
+    tracker, stopped_at = feed_all(tokens)
+    assert tracker.complete == 2
+    assert stopped_at == len(tokens) - 1
+
+
+def test_done_when_text_follows_last_call():
+    tokens = call("get_weather", "Paris") + ["Sure", ", checking now"]
+    tracker, stopped_at = feed_all(tokens)
+    assert tracker.complete == 1
+    assert stopped_at == len(tokens) - 2
+
+
+def test_waiting_after_call_without_more_output():
+    tracker, stopped_at = feed_all(call("get_weather", "Paris") + ["\n"])
+    assert tracker.complete == 1
+    assert stopped_at is None
+    assert not tracker.done
+
+
+def test_markers_split_across_tokens():
+    tokens = ["<start_function_call>call:a{}<end_func", "tion_call>", "<start_func", "tion_call>call:b{}",
+              "<end_function_call>", "<end_of_turn>"]
+    tracker, stopped_at = feed_all(tokens)
+    assert tracker.complete == 2
+    assert stopped_at == len(tokens) - 1
+
+
+def test_markers_inside_escaped_strings_are_ignored():
+    tokens = ["<start_function_call>call:send{text:", "<escape>", "<end_function_call> hi", "<escape>", "}"]
+    tracker, stopped_at = feed_all(tokens)
+    assert tracker.complete == 0
+    assert stopped_at is None
+
+
+def test_escape_after_closed_call_finishes():
+    tokens = call("get_weather", "Paris") + ["<escape>"]
+    tracker, stopped_at = feed_all(tokens)
+    assert stopped_at == len(tokens) - 1
@@ -0,0 +1,76 @@
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import src.main as main
+from src.main import _ResultCache, _get_tool_index, _result_cache_key
+
+WEATHER = {
+    "name": "get_weather",
+    "description": "Get current weather for a location",
+    "parameters": {
+        "type": "object",
+        "properties": {"location": {"type": "string", "description": "City name"}},
+        "required": ["location"],
+    },
+}
+QUERY = "What is the weather in Paris"
+
+
+def weather_result(city="Paris"):
+    return {
+        "function_calls": [{"name": "get_weather", "arguments": {"location": city}}],
+        "confidence": 0.9,
+        "source": "on-device",
+    }
+
+
+def stored(cache, tools, text=QUERY, result=None):
+    key = _result_cache_key(text, _get_tool_index(tools))
+    cache.put(key, result or weather_result(), tools)
+    return key
+
+
+def test_hit_returns_stored_calls():
+    tools = [copy.deepcopy(WEATHER)]
+    cache = _ResultCache()
+    key = stored(cache, tools)
+    hit = cache.get(key, tools)
+    assert hit["source"] == "on-device (cache)"
+    assert [c.to_dict() for c in hit["function_calls"]] == weather_result()["function_calls"]
+    assert cache.stats()["hits"] == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    tools = [copy.deepcopy(WEATHER)]
+    cache = _ResultCache(ttl_s=10.0)
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    key = stored(cache, tools)
+    now[0] += 11.0
+    assert cache.get(key, tools) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    tools = [copy.deepcopy(WEATHER)]
+    cache = _ResultCache(max_size=2)
+    paris = stored(cache, tools, "weather in Paris", weather_result("Paris"))
+    rome = stored(cache, tools, "weather in Rome", weather_result("Rome"))
+    assert cache.get(paris, tools) is not None  # Rome is now least recently used
+    stored(cache, tools, "weather in Oslo", weather_result("Oslo"))
+    assert cache.get(rome, tools) is None
+    assert cache.get(paris, tools) is not None
+
+
+def test_in_place_tool_change_invalidates():
+    tools = [copy.deepcopy(WEATHER)]
+    cache = _ResultCache()
+    old_key = stored(cache, tools)
+    tools[0]["name"] = "get_forecast"
+    assert _result_cache_key(QUERY, _get_tool_index(tools)) != old_key
+    # Even under the old key, calls to a tool that no longer exists are not served.
+    assert cache.get(old_key, tools) is None
+    assert cache.stats()["size"] == 0
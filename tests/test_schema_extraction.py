@@ -0,0 +1,52 @@
+import json
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "app/backend"))
+
+from src.main import _extract_from_schema
+from slack_tools.schemas import SLACK_POST_MESSAGE
+
+with open(os.path.join(ROOT, "app/backend/notion_tools/schemas.json")) as f:
+    NOTION_TOOLS = {t["function"]["name"]: t["function"] for t in json.load(f)}
+
+SLACK_POST = SLACK_POST_MESSAGE["function"]
+
+
+def args_for(query, tool):
+    call = _extract_from_schema(query, tool)
+    return call and call["arguments"]
+
+
+def test_slack_content_overrides_time_for_thread_ts():
+    # thread_ts is both a time and a content param: "saying ..." wins over "at 9 am".
+    assert args_for("Tell @bob at 9 am saying the build is green", SLACK_POST) == {
+        "channel": "@bob",
+        "text": "the build is green",
+        "thread_ts": "the build is green",
+    }
+
+
+def test_slack_time_kept_when_no_content_marker():
+    assert args_for("Post to #random at 3 pm", SLACK_POST) == {
+        "channel": "#random",
+        "thread_ts": "3 pm",
+        "text": "#random at",
+    }
+
+
+def test_slack_that_says_marker():
+    assert args_for("Post in #general that says deploy done", SLACK_POST) == {
+        "channel": "#general",
+        "text": "deploy done",
+        "thread_ts": "deploy done",
+    }
+
+
+def test_notion_search_query_from_leftover_text():
+    assert args_for("Search Notion for meeting notes about Q3", NOTION_TOOLS["notion_search"]) == {
+        "page_size": 0,
+        "query": "meeting notes about Q3",
+    }
@@ -0,0 +1,112 @@
+import ast
+import json
+import os
+import re
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "app/backend"))
+
+from src.main import _compile_tool_grammar
+from slack_tools.schemas import (
+    SLACK_GET_HISTORY,
+    SLACK_LIST_CONVERSATIONS,
+    SLACK_POST_MESSAGE,
+    SLACK_UPLOAD_FILE,
+)
+
+with open(os.path.join(ROOT, "app/backend/notion_tools/schemas.json")) as f:
+    NOTION_TOOLS = [t["function"] for t in json.load(f)]
+
+SLACK_TOOLS = [
+    t["function"]
+    for t in (SLACK_POST_MESSAGE, SLACK_LIST_CONVERSATIONS, SLACK_GET_HISTORY, SLACK_UPLOAD_FILE)
+]
+
+
+def _system_tools():
+    # server.py needs fastapi to import; read the SYSTEM_TOOLS literal instead.
+    with open(os.path.join(ROOT, "app/backend/server.py")) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            getattr(t, "id", None) == "SYSTEM_TOOLS" for t in node.targets
+        ):
+            return ast.literal_eval(node.value)
+    raise AssertionError("SYSTEM_TOOLS not found in server.py")
+
+
+SYSTEM_TOOLS = _system_tools()
+
+
+def rules(grammar):
+    return dict(line.split(" ::= ", 1) for line in grammar.strip().splitlines())
+
+
+def tool_rule(grammar, name):
+    return next(body for body in rules(grammar).values() if body.startswith(f'"{name}{{"'))
+
+
+def assert_well_formed(grammar, tools):
+    defined = rules(grammar)
+    for body in defined.values():
+        unquoted = re.sub(r'"(\\.|[^"\\])*"|\[[^\]]*\]', " ", body)
+        for ref in re.findall(r"[a-z][a-z0-9-]*", unquoted):
+            assert ref in defined, ref
+    assert defined["call"].count("tool-") == len(tools)
+    for tool in tools:
+        tool_rule(grammar, tool["name"])
+
+
+def test_system_tools():
+    grammar = _compile_tool_grammar(SYSTEM_TOOLS)
+    assert_well_formed(grammar, SYSTEM_TOOLS)
+    assert rules(grammar)["root"] == "call+"
+    assert tool_rule(grammar, "set_alarm") == '"set_alarm{" "hour:" int "," "minute:" int "}"'
+    assert tool_rule(grammar, "get_weather") == '"get_weather{" "location:" str "}"'
+
+
+def test_slack_tools_required_then_optional():
+    grammar = _compile_tool_grammar(SLACK_TOOLS)
+    assert_well_formed(grammar, SLACK_TOOLS)
+    assert tool_rule(grammar, "slack_upload_file") == (
+        '"slack_upload_file{" "channels:" any "," "file_path:" str'
+        ' ("," "filename:" str)? ("," "initial_comment:" str)? "}"'
+    )
+
+
+def test_slack_tool_with_only_optional_params():
+    grammar = _compile_tool_grammar(SLACK_TOOLS)
+    one = '("types:" str | "limit:" int)'
+    assert tool_rule(grammar, "slack_list_conversations") == (
+        f'"slack_list_conversations{{" ({one} ("," {one})*)? "}}"'
+    )
+
+
+def test_notion_tools():
+    grammar = _compile_tool_grammar(NOTION_TOOLS)
+    assert_well_formed(grammar, NOTION_TOOLS)
+    assert tool_rule(grammar, "notion_get_page") == '"notion_get_page{" "page_id:" str "}"'
+
+
+def test_string_enum_and_no_parameters():
+    tools = [
+        {
+            "name": "set_lights",
+            "parameters": {
+                "type": "object",
+                "properties": {"state": {"type": "string", "enum": ["on", "off"]}},
+                "required": ["state"],
+            },
+        },
+        {"name": "ping", "parameters": {"type": "object", "properties": {}}},
+        {"name": "noop"},
+    ]
+    grammar = _compile_tool_grammar(tools)
+    assert_well_formed(grammar, tools)
+    assert tool_rule(grammar, "set_lights") == (
+        '"set_lights{" "state:" ("<escape>" "on" "<escape>" | "<escape>" "off" "<escape>") "}"'
+    )
+    assert tool_rule(grammar, "ping") == '"ping{" "}"'
+    assert tool_rule(grammar, "noop") == '"noop{" "}"'